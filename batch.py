@@ -0,0 +1,318 @@
+# Batch processing of many keychains.
+#
+# Keychains are discovered below a directory by their file signature, paired with their unlock material from
+# a manifest and handed to a pool of long lived worker processes, so the interpreter and its imports are only
+# paid for once per worker. Every keychain runs under its own timeout and its errors are reported in its
+# result instead of ending the batch.
+#
+# run() is a pipeline of three stages joined by bounded queues: reader threads prefetch the next keychain
+# files (slow evidence storage is read while the workers decrypt), the pool decrypts them, and the caller
+# writes the results as they come. A full queue stops the stage before it, so neither the read ahead nor
+# the unwritten results grow without bound. With a cost estimate, quick jobs are started first and long
+# ones only get a share of the workers. A collector thread makes sure every job yields a result, also when
+# its result can not be sent back or its worker process dies.
+
+import csv
+import functools
+import itertools
+import json
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from Queue import Queue, Empty
+from multiprocessing.pool import ThreadPool
+from multiprocessing.queues import SimpleQueue
+
+KEYCHAIN_SIGNATURE = 'kych'
+
+# manifest columns, named after the KeyChain.unlock() arguments
+UNLOCK_KINDS = ('password', 'masterkey', 'unlockfile')
+
+# threads reading keychain files ahead of the workers
+READERS = 4
+
+# seconds past its timeout after which a job stuck in a worker is given up
+TIMEOUT_GRACE = 30
+
+# SimpleQueue of (job, worker pid, start time) in the workers of run(), None in other pools
+_started = None
+
+
+class JobTimeout(Exception):
+    pass
+
+
+def discover(root):
+    """Yield the paths of all keychain files below root, recognized by their signature rather than their name"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            if not os.path.isfile(path):
+                continue
+            try:
+                with open(path, 'rb') as f:
+                    if f.read(len(KEYCHAIN_SIGNATURE)) == KEYCHAIN_SIGNATURE:
+                        yield path
+            except IOError:
+                continue
+
+
+def load_manifest(path):
+    """Unlock material by absolute keychain path, from a CSV or JSON manifest.
+
+    A CSV manifest has a path column and one of password, masterkey or unlockfile per row. A JSON manifest is
+    either a list of such objects or an object mapping keychain paths to them. Relative keychain and unlock
+    file paths are relative to the manifest.
+    """
+    base = os.path.dirname(os.path.abspath(path))
+
+    if path.endswith('.json'):
+        with open(path, 'rb') as f:
+            entries = json.load(f)
+        if isinstance(entries, dict):
+            entries = [dict(material, path=keychain) for keychain, material in entries.items()]
+    else:
+        with open(path, 'rb') as f:
+            entries = list(csv.DictReader(f))
+
+    manifest = {}
+    for entry in entries:
+        material = {}
+        for kind in UNLOCK_KINDS:
+            if entry.get(kind):
+                material[kind] = str(entry[kind])
+        if 'unlockfile' in material:
+            material['unlockfile'] = os.path.join(base, material['unlockfile'])
+        manifest[os.path.normpath(os.path.join(base, str(entry['path'])))] = material
+
+    return manifest
+
+
+def _alarm(signum, frame):
+    raise JobTimeout()
+
+
+def _initworker(started=None):
+    global _started
+    _started = started
+    signal.signal(signal.SIGALRM, _alarm)
+
+
+def _runjob(task, job=None):
+    process, path, material, timeout = task
+    start = time.time()
+    if _started is not None and job is not None:
+        _started.put((job, os.getpid(), start))
+
+    if timeout:
+        signal.alarm(timeout)
+    try:
+        try:
+            status, records = process(path, material)
+            error = None
+        finally:
+            signal.alarm(0)
+    except JobTimeout:
+        status, records, error = 'timeout', [], 'no result after %d seconds' % timeout
+    except Exception as e:
+        status, records, error = 'error', [], '%s: %s' % (type(e).__name__, e)
+
+    return path, status, error, records, time.time() - start
+
+
+def _read(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read() or None
+    except IOError:
+        return None
+
+
+## reader thread: load the keychain files of pending jobs into prefetched tasks with the time they were ready,
+## None when out of jobs
+def _prefetch(pending, prefetched, process, timeout):
+    while True:
+        job = pending.get()
+        if job is None:
+            prefetched.put(None)
+            return
+        path, material, job_class = job
+        data = _read(path)
+        if data is not None:
+            task = functools.partial(process, data=data), path, material, timeout
+        else:
+            task = process, path, material, timeout  # the worker reports why
+        prefetched.put((task, job_class, time.time()))
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+
+## dispatcher thread of a lane: hand prefetched tasks to the pool while fewer than slots are unfinished or
+## unwritten, and fewer than running of a limited job class are in the pool
+def _dispatch(pool, prefetched, readers, slots, running, numbers, submitted, done):
+    while readers:
+        item = prefetched.get()
+        if item is None:
+            readers -= 1
+            continue
+        task, job_class, ready = item
+        if running is not None:
+            running.acquire()
+        slots.acquire()
+        job = next(numbers)
+        try:
+            result = pool.apply_async(_runjob, (task, job), callback=functools.partial(_putresult, done, job))
+        except ValueError:
+            return  # the caller stopped early and the pool is gone
+        submitted.put((job, result, task[1], job_class, running, ready))
+
+
+def _putresult(done, job, result):
+    done.put((job, result))
+
+
+## collector thread: queue a result for every submitted job, with its class and the seconds from its file being
+## read until a worker started it, and free its slot of a limited job class. Results normally come from the pool
+## callback, a job whose result can not be sent back (the callback is not called) or whose worker process died
+## (nothing comes back) gets an error result.
+def _collect(submitted, done, started, results, timeout, stop):
+    outstanding = {}  # job -> (AsyncResult, path, job class, running, ready time)
+    finished = {}  # job -> result, from the callback
+    starts = {}  # job -> (worker pid, start time)
+    while not stop.is_set():
+        try:
+            job, result = done.get(timeout=0.1)
+            finished[job] = result
+        except Empty:
+            pass
+        try:
+            while True:
+                job, result, path, job_class, running, ready = submitted.get_nowait()
+                outstanding[job] = result, path, job_class, running, ready
+        except Empty:
+            pass
+        while not started.empty():
+            job, pid, started_at = started.get()
+            starts[job] = pid, started_at
+
+        now = time.time()
+        for job, (result, path, job_class, running, ready) in outstanding.items():
+            if job in finished:
+                path, status, error, records, seconds = finished.pop(job)
+            else:
+                if result.ready():
+                    try:
+                        result.get()
+                        continue  # succeeded, the callback is on its way
+                    except Exception as e:
+                        status, error = 'error', '%s: %s' % (type(e).__name__, e)
+                elif job in starts and not _alive(starts[job][0]):
+                    status, error = 'error', 'worker process exited'
+                elif job in starts and timeout and now - starts[job][1] > timeout + TIMEOUT_GRACE:
+                    status, error = 'timeout', 'no result after %d seconds, the worker does not respond' % timeout
+                else:
+                    continue
+                records = []
+                seconds = now - starts[job][1] if job in starts else 0.0
+
+            del outstanding[job]
+            started_at = starts.pop(job, (None, now - seconds))[1]
+            if running is not None:
+                running.release()
+            results.put((path, status, error, records, seconds, job_class, max(0.0, started_at - ready)))
+
+
+def schedule(jobs, estimate=None, threads=READERS):
+    """(path, material, job class) of jobs, cheapest first.
+
+    estimate(path, material) returns the (job class, estimated seconds) of a job, it is called from threads
+    threads at a time since it usually reads from the keychain. Without it every job has the class 'keychain'
+    and keeps its place.
+    """
+    jobs = list(jobs)
+    if estimate is None or not jobs:
+        return [(path, material, 'keychain') for path, material in jobs]
+
+    estimator = ThreadPool(max(1, min(threads, len(jobs))))
+    try:
+        costs = estimator.map(lambda job: estimate(*job), jobs)
+    finally:
+        estimator.terminate()
+
+    order = sorted(xrange(len(jobs)), key=lambda i: costs[i][1])
+    return [jobs[i] + (costs[i][0],) for i in order]
+
+
+def run(process, jobs, processes=None, timeout=None, readers=READERS, depth=None, estimate=None, limits={}):
+    """Call process(path, unlock material, data=keychain data) for every (path, material) of jobs on a pool of
+    worker processes.
+
+    process must be a picklable module level function (or functools.partial of one) returning (status, records).
+    It gets no data when the file could not be read. Yields (path, status, error, records, seconds, job class,
+    seconds from the keychain being read until a worker started it) in the order the keychains finish. A keychain
+    that raises or runs longer than timeout seconds gets the status 'error' or 'timeout', so does one whose result
+    can not be pickled or whose worker process dies.
+
+    Jobs are started in schedule() order, cheapest first with an estimate function, and at most limits[job class]
+    jobs of a limited class are in the pool at any time, so long jobs can not hold every worker. Every job class
+    of limits is a lane, and the order only holds within a lane: lanes are fed side by side, so a costly job of
+    one lane can start before a cheaper one of another. Every lane has its own readers: readers threads read up to
+    depth keychains ahead (twice the processes by default), and at most depth results are decrypting or waiting
+    for the caller.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    depth = depth or 2 * processes
+    jobs = schedule(jobs, estimate, readers)
+
+    lanes = {}
+    for path, material, job_class in jobs:
+        lanes.setdefault(job_class if job_class in limits else None, []).append((path, material, job_class))
+
+    results = Queue()
+    slots = threading.Semaphore(depth)
+    submitted, done, stop = Queue(), Queue(), threading.Event()
+    started = SimpleQueue()  # written before the job runs, a worker that dies can not lose it
+    numbers = itertools.count()
+    collector = threading.Thread(target=_collect, args=(submitted, done, started, results, timeout, stop))
+
+    pool = multiprocessing.Pool(processes, _initworker, (started,))
+    try:
+        stages = [collector]
+        for lane, lane_jobs in lanes.items():
+            lane_readers = max(1, min(readers, len(lane_jobs)))
+            pending = Queue()
+            for job in lane_jobs:
+                pending.put(job)
+            for i in xrange(lane_readers):
+                pending.put(None)
+            prefetched = Queue(depth)
+            running = threading.Semaphore(max(1, limits[lane])) if lane is not None else None
+
+            stages.extend(threading.Thread(target=_prefetch, args=(pending, prefetched, process, timeout))
+                          for i in xrange(lane_readers))
+            stages.append(threading.Thread(target=_dispatch, args=(pool, prefetched, lane_readers, slots, running,
+                                                                   numbers, submitted, done)))
+        for stage in stages:
+            stage.daemon = True
+            stage.start()
+
+        for i in xrange(len(jobs)):
+            result = results.get()
+            slots.release()
+            yield result
+        pool.close()
+    finally:
+        stop.set()
+        if collector.is_alive():
+            collector.join()
+        pool.terminate()
+        pool.join()
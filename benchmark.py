@@ -0,0 +1,242 @@
+#!/usr/bin/python
+
+# Micro-benchmarks for the chainbreaker crypto and parsing kernels.
+#
+#   $ python benchmark.py [-t SECONDS] [-b NAME ...] [--import-budget MS] [--json FILE] [--compare FILE]
+#
+# Every benchmark runs on synthetic blobs and tables built with random keys, so no keychain file is needed.
+# The import of chainbreaker is timed first, in fresh interpreters: the exit status is 1 if it takes
+# longer than the budget or loads a module that should only be imported by the feature using it.
+#
+# --json saves the results (operations per second) with the interpreter and platform they were measured on,
+# --compare prints the change against such a file, so a change to these modules comes with before/after numbers:
+#
+#   $ python benchmark.py --json before.json
+#   $ python benchmark.py --compare before.json
+
+import argparse
+import json
+import os
+import platform
+import struct
+import subprocess
+import sys
+import time
+from binascii import unhexlify
+
+from pyDes import des, triple_des, CBC, ECB
+from pbkdf2 import pbkdf2
+
+from chainbreaker import KeyChain, kcdecrypt, _memcpy, _GENERIC_PW_HEADER, _TABLE_HEADER, KEYLEN
+
+MAGIC_CMS_IV = unhexlify('4adda22c79e82105')
+
+PRIVATE_KEY_SIZE = 1218  # DER encoded 2048 bit RSA private key
+
+BLOCKS = 64  # blocks per call of the block throughput benchmarks
+
+TABLE_SLOTS = 1024  # record offset slots of the getTable benchmark
+
+IMPORT_BUDGET = 120  # ms
+
+# modules importing chainbreaker must not load
+DEFERRED_MODULES = ('OpenSSL', 'Crypto', 'cryptography', 'hexdump', 'sqlite3', 'tarfile', 'zipfile', 'BaseHTTPServer',
+                    'validator', 'cache', 'export', 'batch', 'service', 'argparse', 'multiprocessing')
+
+IMPORT_PROBE = ("import sys, time; start = time.time(); import chainbreaker; "
+                "print time.time() - start; print ' '.join(sys.modules)")
+
+
+## PKCS#7 padding as used by kcdecrypt
+def _pad(data):
+    pad = 8 - len(data) % 8
+    return data + chr(pad) * pad
+
+
+## 3DES-CBC encryption built on the ECB primitive (pyDes has no tested CBC encrypt)
+def _cbc_encrypt(key, iv, data):
+    cipher = triple_des(key, ECB)
+    lastblock = iv
+    result = []
+    for i in range(0, len(data), 8):
+        block = ''.join(chr(ord(x) ^ ord(y)) for x, y in zip(lastblock, data[i:i + 8]))
+        lastblock = cipher.encrypt(block)
+        result.append(lastblock)
+    return ''.join(result)
+
+
+## wrap a private key the way securityd does: CBC with the item IV, reverse, CBC with the magic CMS IV
+def make_private_key_blob(dbkey, iv, keysize=PRIVATE_KEY_SIZE):
+    inner = _cbc_encrypt(dbkey, iv, _pad('keyname-0001' + os.urandom(keysize)))
+    return _cbc_encrypt(dbkey, MAGIC_CMS_IV, _pad(inner[::-1]))
+
+
+def measure(func, seconds):
+    """Call func repeatedly for about `seconds`, returns calls per second"""
+    count = 0
+    start = time.time()
+    elapsed = 0
+    while elapsed < seconds:
+        func()
+        count += 1
+        elapsed = time.time() - start
+    return count / elapsed
+
+
+def check_import(runs=5):
+    """Import chainbreaker in fresh interpreters, returns the fastest import in ms and the deferred modules it loaded"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for i in xrange(runs):
+        seconds, modules = subprocess.check_output([sys.executable, '-c', IMPORT_PROBE], cwd=here).split('\n', 1)
+        best = min(best, float(seconds)) if best is not None else float(seconds)
+    loaded = sorted(set(module.split('.')[0] for module in modules.split()) & set(DEFERRED_MODULES))
+    return best * 1000, loaded
+
+
+def bench_private_key_unwrap(seconds):
+    dbkey = os.urandom(24)
+    iv = os.urandom(8)
+    blob = make_private_key_blob(dbkey, iv)
+    keychain = KeyChain('')
+
+    keyname, privatekey = keychain.PrivateKeyDecryption(blob, iv, dbkey)
+    if len(privatekey) != PRIVATE_KEY_SIZE:
+        raise AssertionError('private key blob did not round trip')
+
+    return measure(lambda: keychain.PrivateKeyDecryption(blob, iv, dbkey), seconds)
+
+
+def bench_des_blocks(seconds):
+    cipher = des(os.urandom(8), CBC, os.urandom(8))
+    data = os.urandom(BLOCKS * 8)
+    return measure(lambda: cipher.decrypt(data), seconds) * BLOCKS
+
+
+def bench_3des_blocks(seconds):
+    cipher = triple_des(os.urandom(24), CBC, os.urandom(8))
+    data = os.urandom(BLOCKS * 8)
+    return measure(lambda: cipher.decrypt(data), seconds) * BLOCKS
+
+
+def bench_3des_key_schedule(seconds):
+    key = os.urandom(24)
+    iv = os.urandom(8)
+    return measure(lambda: triple_des(key, CBC, iv), seconds)
+
+
+## kcdecrypt of a SSGP item holding a secret of size bytes
+def bench_kcdecrypt(size):
+    def bench(seconds):
+        key = os.urandom(24)
+        iv = os.urandom(8)
+        secret = os.urandom(size)
+        ciphertext = _cbc_encrypt(key, iv, _pad(secret))
+        if kcdecrypt(key, iv, ciphertext) != secret:
+            raise AssertionError('SSGP blob did not round trip')
+        return measure(lambda: kcdecrypt(key, iv, ciphertext), seconds)
+    return bench
+
+
+def bench_pbkdf2(seconds):
+    salt = os.urandom(20)
+    return measure(lambda: pbkdf2('password', salt, 1000, KEYLEN), seconds)
+
+
+def bench_getlv(seconds):
+    keychain = KeyChain('')
+    keychain.fbuf = '\x00' * 4 + struct.pack('>I', 13) + 'www.apple.com\x00\x00\x00'
+    if keychain.getLV(0, 4).rstrip('\x00') != 'www.apple.com':
+        raise AssertionError('getLV did not decode the attribute')
+    return measure(lambda: keychain.getLV(0, 4), seconds)
+
+
+def bench_record_header(seconds):
+    header = os.urandom(len(buffer(_GENERIC_PW_HEADER())))
+    return measure(lambda: _memcpy(header, _GENERIC_PW_HEADER), seconds)
+
+
+## getTable on a table of TABLE_SLOTS record offsets, every fourth slot free
+def bench_gettable(seconds):
+    offsets = [0 if i % 4 == 3 else 0x1000 + i * 4 for i in xrange(TABLE_SLOTS)]
+    records = len([offset for offset in offsets if offset])
+    table_size = len(buffer(_TABLE_HEADER())) + 4 * TABLE_SLOTS
+
+    keychain = KeyChain('')
+    keychain.fbuf = ('\x00' * 20 + struct.pack('>7I', table_size, 0x80000000, records, 0, 0, 0, TABLE_SLOTS) +
+                     struct.pack('>%dI' % TABLE_SLOTS, *offsets))
+    if len(keychain.getTable(0)[1]) != records:
+        raise AssertionError('getTable did not find every record offset')
+    return measure(lambda: keychain.getTable(0), seconds) * TABLE_SLOTS
+
+
+BENCHMARKS = [
+    ('DES blocks decrypted/s', bench_des_blocks),
+    ('3DES blocks decrypted/s', bench_3des_blocks),
+    ('3DES key schedules/s', bench_3des_key_schedule),
+    ('kcdecrypt 16 byte secrets/s', bench_kcdecrypt(16)),
+    ('kcdecrypt 256 byte secrets/s', bench_kcdecrypt(256)),
+    ('private keys unwrapped/s', bench_private_key_unwrap),
+    ('PBKDF2 derivations/s', bench_pbkdf2),
+    ('getLV attributes decoded/s', bench_getlv),
+    ('record headers decoded/s', bench_record_header),
+    ('getTable offsets scanned/s', bench_gettable),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='chainbreaker micro-benchmarks')
+    parser.add_argument('-t', '--time', type=float, default=3.0, help='Seconds per benchmark (default: 3)')
+    parser.add_argument('-b', '--bench', nargs='+', metavar='NAME',
+                        help='Only run the benchmarks whose name contains one of these')
+    parser.add_argument('--import-budget', type=float, default=IMPORT_BUDGET,
+                        help='Milliseconds importing chainbreaker may take (default: %d)' % IMPORT_BUDGET)
+    parser.add_argument('--json', nargs=1, metavar='FILE', help='Save the results as JSON')
+    parser.add_argument('--compare', nargs=1, metavar='FILE', help='Compare with the results saved in FILE')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare is not None:
+        with open(args.compare[0], 'rb') as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+
+    ## one result line, with the change against the baseline
+    def report(name, value):
+        results[name] = value
+        line = '%-32s %12.2f' % (name, value)
+        if baseline.get(name):
+            line += '  %12.2f  %+7.1f%%' % (baseline[name], (value - baseline[name]) * 100.0 / baseline[name])
+        print line
+
+    if args.compare is not None:
+        print '%-32s %12s  %12s  %8s' % ('', 'now', 'before', 'change')
+
+    import_ms, loaded = check_import()
+    report('import chainbreaker (ms)', import_ms)
+    failed = False
+    if import_ms > args.import_budget:
+        print '[!] importing chainbreaker takes longer than %d ms' % args.import_budget
+        failed = True
+    if loaded:
+        print '[!] importing chainbreaker loads %s' % ', '.join(loaded)
+        failed = True
+
+    for name, bench in BENCHMARKS:
+        if args.bench is None or any(pattern.lower() in name.lower() for pattern in args.bench):
+            report(name, bench(args.time))
+
+    if args.json is not None:
+        with open(args.json[0], 'wb') as f:
+            json.dump({'python': sys.version.split()[0], 'implementation': platform.python_implementation(),
+                       'platform': platform.platform(), 'seconds': args.time,
+                       'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results},
+                      f, indent=2, sort_keys=True)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
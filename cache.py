@@ -0,0 +1,400 @@
+# On-disk caches that let repeated runs over the same evidence skip work.
+#
+# PlaintextCache: content addressed cache of decrypted keychain items. An entry is addressed by a hash of
+# (unwrapped key, IV, ciphertext), so an item that is byte identical in several snapshots of a keychain is
+# only decrypted once. The plaintext is stored encrypted (AES-CTR + HMAC-SHA256) under a key derived from
+# the same inputs, so the cache directory is useless without the keychain's own key material. The cache is
+# kept under max_size by evicting the least recently used entries when it is closed.
+#
+# KeyCache: database keys of keychains unlocked with a password, so the next run with the same password
+# skips PBKDF2. Entries are addressed and encrypted with a random local secret kept in the cache directory,
+# expire after ttl seconds and the least recently used ones are evicted beyond max_entries.
+#
+# ResultCache: complete results (records, exports and statistics) of earlier runs, addressed by a streaming
+# hash of the keychain file together with the unlock material and the selected tables and filters. The hash
+# of a file is remembered with its size and mtime, so an unchanged file is not even read again. Like the
+# KeyCache entries, they are addressed and encrypted with a random local secret, so a copy of the entries
+# alone is neither readable nor usable to test password guesses faster than the keychain's own PBKDF2. The
+# least recently used ones are evicted beyond max_entries.
+#
+# SidecarIndex: signatures (RecordSize, ModDate, digest) of every record of a keychain as of the last
+# incremental run, so the next run only decodes and decrypts the records that were added or modified.
+
+import cPickle
+import hashlib
+import hmac
+import json
+import os
+import struct
+import tempfile
+import time
+from binascii import hexlify
+
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
+
+MACLEN = 32
+SECRETLEN = 32
+
+
+## every entry has its own key, so a fixed initial counter is safe
+def _ctr(enckey):
+    return AES.new(enckey, AES.MODE_CTR, counter=Counter.new(128, initial_value=0))
+
+
+## write through a temporary file so concurrent runs never see a partial entry
+def _atomicwrite(directory, name, data):
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, os.path.join(directory, name))
+
+
+## the local secret protecting a cache directory, created on first use and readable by the owner only
+def _loadsecret(directory, name):
+    secret_path = os.path.join(directory, name)
+    try:
+        fd = os.open(secret_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+    except OSError:
+        with open(secret_path, 'rb') as f:
+            return f.read()
+    secret = os.urandom(SECRETLEN)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(secret)
+    return secret
+
+
+## (mtime, size, name) of the entries of a cache directory
+def _listentries(directory, exclude=()):
+    entries = []
+    for name in os.listdir(directory):
+        if name.startswith('.tmp') or name in exclude:
+            continue
+        try:
+            st = os.stat(os.path.join(directory, name))
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, name))
+    return entries
+
+
+## remove an entry, False if it was already gone
+def _remove(directory, name):
+    try:
+        os.remove(os.path.join(directory, name))
+    except OSError:
+        return False
+    return True
+
+
+class PlaintextCache:
+    def __init__(self, path, max_size=256 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    ## entry file name, AES key and MAC key of an item
+    def _derive(self, key, iv, data):
+        digest = hashlib.sha512(struct.pack('>III', len(key), len(iv), len(data)) + key + iv + data).digest()
+        return hexlify(digest[:32]), digest[32:48], digest[48:]
+
+    def get(self, key, iv, data):
+        """Return the cached plaintext of an item, or None"""
+        name, enckey, mackey = self._derive(key, iv, data)
+        entry_path = os.path.join(self.path, name)
+
+        try:
+            with open(entry_path, 'rb') as f:
+                entry = f.read()
+        except IOError:
+            self.misses += 1
+            return None
+
+        if not hmac.compare_digest(entry[:MACLEN], hmac.new(mackey, entry[MACLEN:], hashlib.sha256).digest()):
+            self.misses += 1
+            return None
+
+        # mark as recently used
+        try:
+            os.utime(entry_path, None)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return _ctr(enckey).decrypt(entry[MACLEN:])
+
+    def put(self, key, iv, data, plain):
+        name, enckey, mackey = self._derive(key, iv, data)
+
+        ciphertext = _ctr(enckey).encrypt(plain)
+        _atomicwrite(self.path, name, hmac.new(mackey, ciphertext, hashlib.sha256).digest() + ciphertext)
+
+    def trim(self):
+        """Evict least recently used entries until the cache fits in max_size"""
+        entries = sorted(_listentries(self.path))
+        total = sum(size for mtime, size, name in entries)
+
+        for mtime, size, name in entries:
+            if total <= self.max_size:
+                break
+            if _remove(self.path, name):
+                total -= size
+                self.evictions += 1
+
+        return total
+
+    def close(self):
+        return self.trim()
+
+    def getStats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class KeyCache:
+    SECRET_NAME = 'secret'
+
+    def __init__(self, path, ttl=3600, max_entries=1000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if not os.path.exists(path):
+            os.makedirs(path, 0700)
+        self.secret = _loadsecret(path, self.SECRET_NAME)
+
+    ## entry file name, AES key and MAC key of a (keychain, password) pair
+    def _derive(self, blobid, password):
+        name = hmac.new(self.secret, blobid + hashlib.sha256(password).digest(), hashlib.sha256).hexdigest()
+        keys = hmac.new(self.secret, 'entry' + name, hashlib.sha512).digest()
+        return name, keys[:16], keys[16:48]
+
+    def get(self, blobid, password):
+        """Return the cached database key of a keychain (DBBlob salt + randomSignature) and password, or None"""
+        name, enckey, mackey = self._derive(blobid, password)
+        entry_path = os.path.join(self.path, name)
+
+        try:
+            with open(entry_path, 'rb') as f:
+                entry = f.read()
+        except IOError:
+            self.misses += 1
+            return None
+
+        if not hmac.compare_digest(entry[:MACLEN], hmac.new(mackey, entry[MACLEN:], hashlib.sha256).digest()):
+            self.misses += 1
+            return None
+
+        created = struct.unpack('>Q', entry[MACLEN:MACLEN + 8])[0]
+        if time.time() - created > self.ttl:
+            if _remove(self.path, name):
+                self.evictions += 1
+            self.misses += 1
+            return None
+
+        # mark as recently used
+        try:
+            os.utime(entry_path, None)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return _ctr(enckey).decrypt(entry[MACLEN + 8:])
+
+    def put(self, blobid, password, dbkey):
+        name, enckey, mackey = self._derive(blobid, password)
+
+        body = struct.pack('>Q', int(time.time())) + _ctr(enckey).encrypt(dbkey)
+        _atomicwrite(self.path, name, hmac.new(mackey, body, hashlib.sha256).digest() + body)
+
+    def trim(self):
+        """Drop expired entries, then the least recently used ones beyond max_entries"""
+        entries = sorted(_listentries(self.path, exclude=(self.SECRET_NAME,)))
+        now = time.time()
+
+        kept = []
+        for mtime, size, name in entries:
+            entry_path = os.path.join(self.path, name)
+            try:
+                with open(entry_path, 'rb') as f:
+                    created = struct.unpack('>Q', f.read(MACLEN + 8)[MACLEN:])[0]
+            except (IOError, struct.error):
+                created = 0
+            if now - created > self.ttl:
+                if _remove(self.path, name):
+                    self.evictions += 1
+            else:
+                kept.append(name)
+
+        for name in kept[:max(len(kept) - self.max_entries, 0)]:
+            if _remove(self.path, name):
+                self.evictions += 1
+
+        return min(len(kept), self.max_entries)
+
+    def close(self):
+        return self.trim()
+
+    def getStats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class ResultCache:
+    INDEX_NAME = 'index'
+    SECRET_NAME = 'secret'
+    HASH_CHUNK = 1024 * 1024
+
+    def __init__(self, path, max_entries=1000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.index = None
+        self.index_dirty = False
+
+        if not os.path.exists(path):
+            os.makedirs(path, 0700)
+        self.secret = _loadsecret(path, self.SECRET_NAME)
+
+    ## path -> [size, mtime, sha256] of the files hashed so far
+    def _loadindex(self):
+        if self.index is None:
+            try:
+                with open(os.path.join(self.path, self.INDEX_NAME), 'rb') as f:
+                    self.index = json.load(f)
+            except (IOError, ValueError):
+                self.index = {}
+        return self.index
+
+    def fingerprint(self, filepath):
+        """Return the content hash of a file, rehashing it only if its size or mtime changed"""
+        filepath = os.path.abspath(filepath)
+        st = os.stat(filepath)
+        index = self._loadindex()
+
+        known = index.get(filepath)
+        if known is not None and known[0] == st.st_size and known[1] == st.st_mtime:
+            return str(known[2])
+
+        digest = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            while True:
+                chunk = f.read(self.HASH_CHUNK)
+                if not chunk:
+                    break
+                digest.update(chunk)
+
+        index[filepath] = [st.st_size, st.st_mtime, digest.hexdigest()]
+        self.index_dirty = True
+        return digest.hexdigest()
+
+    ## entry file name, AES key and MAC key of a (file hash, unlock material, options) triple
+    def _derive(self, fingerprint, unlock_material, options):
+        name = hmac.new(self.secret, fingerprint + hashlib.sha256(repr(unlock_material)).digest() +
+                        hashlib.sha256(repr(options)).digest(), hashlib.sha256).hexdigest()
+        keys = hmac.new(self.secret, 'entry' + name, hashlib.sha512).digest()
+        return name, keys[:16], keys[16:48]
+
+    def get(self, fingerprint, unlock_material, options):
+        """Return the stored result of an identical earlier run, or None"""
+        name, enckey, mackey = self._derive(fingerprint, unlock_material, options)
+        entry_path = os.path.join(self.path, name)
+
+        try:
+            with open(entry_path, 'rb') as f:
+                entry = f.read()
+        except IOError:
+            self.misses += 1
+            return None
+
+        if not hmac.compare_digest(entry[:MACLEN], hmac.new(mackey, entry[MACLEN:], hashlib.sha256).digest()):
+            self.misses += 1
+            return None
+
+        # mark as recently used
+        try:
+            os.utime(entry_path, None)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return cPickle.loads(_ctr(enckey).decrypt(entry[MACLEN:]))
+
+    def put(self, fingerprint, unlock_material, options, result):
+        name, enckey, mackey = self._derive(fingerprint, unlock_material, options)
+
+        ciphertext = _ctr(enckey).encrypt(cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL))
+        _atomicwrite(self.path, name, hmac.new(mackey, ciphertext, hashlib.sha256).digest() + ciphertext)
+
+    def clear(self):
+        """Remove every stored result and the file hash index"""
+        for mtime, size, name in _listentries(self.path, exclude=(self.SECRET_NAME,)):
+            if _remove(self.path, name) and name != self.INDEX_NAME:
+                self.evictions += 1
+        self.index = {}
+        self.index_dirty = False
+
+    def trim(self):
+        """Evict the least recently used entries beyond max_entries"""
+        entries = sorted(_listentries(self.path, exclude=(self.INDEX_NAME, self.SECRET_NAME)))
+
+        for mtime, size, name in entries[:max(len(entries) - self.max_entries, 0)]:
+            if _remove(self.path, name):
+                self.evictions += 1
+
+        return min(len(entries), self.max_entries)
+
+    def close(self):
+        if self.index_dirty:
+            _atomicwrite(self.path, self.INDEX_NAME, json.dumps(self.index))
+            self.index_dirty = False
+        return self.trim()
+
+    def getStats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class SidecarIndex:
+    def __init__(self, path):
+        self.path = path
+        self.tables = {}  # table -> {RecordNumber: signature}
+
+        try:
+            with open(path, 'rb') as f:
+                stored = json.load(f)
+        except (IOError, ValueError):
+            stored = {}
+
+        for table, signatures in stored.items():
+            self.tables[int(table)] = dict((int(number), signature) for number, signature in signatures.items())
+
+    ## record signatures of a table from the last run, empty if the table was never processed
+    def getTable(self, table):
+        return self.tables.get(table, {})
+
+    def setTable(self, table, signatures):
+        self.tables[table] = signatures
+
+    ## store the signatures of the records a run output (RecordNumbers in processed) and keep the earlier
+    ## signatures of the ones it skipped, e.g. by a filter, so a later run still sees those as changed or added
+    def updateTable(self, table, signatures, processed):
+        previous = self.getTable(table)
+        updated = {}
+        for number, signature in signatures.items():
+            if number in processed:
+                updated[number] = signature
+            elif number in previous:
+                updated[number] = previous[number]
+        self.tables[table] = updated
+
+    def save(self):
+        directory, name = os.path.split(os.path.abspath(self.path))
+        _atomicwrite(directory, name, json.dumps(self.tables))
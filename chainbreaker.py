@@ -18,13 +18,17 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 #
 
-import argparse
 import os
+import sys
 from sys import exit
 import struct
 from binascii import unhexlify
 import datetime
-from hexdump import hexdump
+import functools
+import hashlib
+import json
+import time
+from collections import namedtuple
 
 from pbkdf2 import pbkdf2
 
@@ -32,7 +36,10 @@ from pyDes import triple_des, CBC
 from ctypes import *
 from Schema import *
 
-from validator import Validator
+from writers import WRITERS, SECRET_ENCODINGS, IDENTITY_TABLE, TextWriter, CsvWriter, SqliteExporter
+
+# validator (pyOpenSSL), cache (AES), export (tar/zip), batch, service, hexdump, argparse and multiprocessing
+# are imported where they are used, so short runs and library users do not pay for features they do not use
 
 ATOM_SIZE = 4
 SIZEOFKEYCHAINTIME = 16
@@ -303,10 +310,185 @@ def _memcpy(buf, fmt):
     return cast(c_char_p(buf), POINTER(fmt)).contents
 
 
+# decoded records, field order matches the historical list layout of the record parsers
+GenericPasswordRecord = namedtuple('GenericPasswordRecord', [
+    'SSGP', 'CreationDate', 'ModDate', 'Description', 'Creator', 'Type', 'PrintName', 'Alias', 'Account', 'Service',
+    'RecordNumber', 'Password'])
+
+InternetPasswordRecord = namedtuple('InternetPasswordRecord', [
+    'SSGP', 'CreationDate', 'ModDate', 'Description', 'Comment', 'Creator', 'Type', 'PrintName', 'Alias', 'Protected',
+    'Account', 'SecurityDomain', 'Server', 'Protocol', 'AuthType', 'Port', 'Path', 'RecordNumber', 'Password'])
+
+AppleSharePasswordRecord = namedtuple('AppleSharePasswordRecord', [
+    'SSGP', 'CreationDate', 'ModDate', 'Description', 'Comment', 'Creator', 'Type', 'PrintName', 'Alias', 'Protected',
+    'Account', 'Volume', 'Server', 'Protocol', 'Address', 'Signature', 'RecordNumber', 'Password'])
+
+X509CertificateRecord = namedtuple('X509CertificateRecord', [
+    'CertType', 'CertEncoding', 'PrintName', 'Alias', 'Subject', 'Issuer', 'SerialNumber', 'SubjectKeyIdentifier',
+    'PublicKeyHash', 'Certificate', 'RecordNumber'])
+
+KeyRecord = namedtuple('KeyRecord', [
+    'PrintName', 'Label', 'KeyClass', 'Private', 'KeyType', 'KeySizeInBits', 'EffectiveKeySize', 'Extractable',
+    'KeyCreator', 'IV', 'Key', 'RecordNumber', 'KeyName', 'PrivateKey'])
+
+# encrypted blobs, secrets and certificate data, left out of the attribute only records of --triage
+BLOB_FIELDS = ('SSGP', 'Password', 'IV', 'Key', 'KeyName', 'PrivateKey', 'Certificate')
+
+GenericPasswordAttributes = namedtuple('GenericPasswordAttributes', [
+    field for field in GenericPasswordRecord._fields if field not in BLOB_FIELDS])
+
+InternetPasswordAttributes = namedtuple('InternetPasswordAttributes', [
+    field for field in InternetPasswordRecord._fields if field not in BLOB_FIELDS])
+
+AppleSharePasswordAttributes = namedtuple('AppleSharePasswordAttributes', [
+    field for field in AppleSharePasswordRecord._fields if field not in BLOB_FIELDS])
+
+X509CertificateAttributes = namedtuple('X509CertificateAttributes', [
+    field for field in X509CertificateRecord._fields if field not in BLOB_FIELDS])
+
+KeyAttributes = namedtuple('KeyAttributes', [field for field in KeyRecord._fields if field not in BLOB_FIELDS])
+
+# --identities row, written as the IDENTITY_TABLE pseudo table
+IdentityRecord = namedtuple('IdentityRecord', ['CertificateName', 'PrivateKeyName', 'PublicKeyHash'])
+
+# record type -> KeyChain parser method
+RECORD_PARSERS = {
+    CSSM_DL_DB_RECORD_GENERIC_PASSWORD: 'getGenericPWRecord',
+    CSSM_DL_DB_RECORD_INTERNET_PASSWORD: 'getInternetPWRecord',
+    CSSM_DL_DB_RECORD_APPLESHARE_PASSWORD: 'getAppleshareRecord',
+    CSSM_DL_DB_RECORD_X509_CERTIFICATE: 'getx509Record',
+    CSSM_DL_DB_RECORD_PUBLIC_KEY: 'getKeyRecord',
+    CSSM_DL_DB_RECORD_PRIVATE_KEY: 'getKeyRecord',
+}
+
+# tables whose secret is a SSGP blob wrapped with a symmetric key
+SSGP_TABLES = (
+    CSSM_DL_DB_RECORD_GENERIC_PASSWORD,
+    CSSM_DL_DB_RECORD_INTERNET_PASSWORD,
+    CSSM_DL_DB_RECORD_APPLESHARE_PASSWORD,
+)
+
+# record type -> its record of KeyChain.iter_attributes()
+ATTRIBUTE_TYPES = {
+    CSSM_DL_DB_RECORD_GENERIC_PASSWORD: GenericPasswordAttributes,
+    CSSM_DL_DB_RECORD_INTERNET_PASSWORD: InternetPasswordAttributes,
+    CSSM_DL_DB_RECORD_APPLESHARE_PASSWORD: AppleSharePasswordAttributes,
+    CSSM_DL_DB_RECORD_X509_CERTIFICATE: X509CertificateAttributes,
+    CSSM_DL_DB_RECORD_PUBLIC_KEY: KeyAttributes,
+    CSSM_DL_DB_RECORD_PRIVATE_KEY: KeyAttributes,
+}
+
+# lookup attribute -> record fields it is indexed from
+INDEXED_ATTRIBUTES = {
+    'service': ('Service',),
+    'account': ('Account',),
+    'server': ('Server',),
+    'label': ('PrintName', 'Label'),
+}
+
+
+# --tables names
+TABLE_NAMES = {
+    'generic': CSSM_DL_DB_RECORD_GENERIC_PASSWORD,
+    'internet': CSSM_DL_DB_RECORD_INTERNET_PASSWORD,
+    'appleshare': CSSM_DL_DB_RECORD_APPLESHARE_PASSWORD,
+    'certificate': CSSM_DL_DB_RECORD_X509_CERTIFICATE,
+    'publickey': CSSM_DL_DB_RECORD_PUBLIC_KEY,
+    'privatekey': CSSM_DL_DB_RECORD_PRIVATE_KEY,
+}
+
+
+## attribute values are stored NUL padded to a 4 byte boundary
+def _indexvalue(value):
+    return str(value).rstrip('\x00')
+
+
+## public key hash attribute of a record: PublicKeyHash of a certificate, Label of a public or private key
+def _publickeyhash(record):
+    if 'PublicKeyHash' in record._fields:
+        return _indexvalue(record.PublicKeyHash)
+    return _indexvalue(record.Label)
+
+
+## True if a decoded record matches every attribute filter (None means no filter)
+def _matchfilters(record, filters):
+    for attribute, value in filters.items():
+        if value is None:
+            continue
+        if attribute not in INDEXED_ATTRIBUTES:
+            raise TypeError('unknown record filter %r' % attribute)
+        value = _indexvalue(value)
+        for field in INDEXED_ATTRIBUTES[attribute]:
+            if field in record._fields and _indexvalue(getattr(record, field)) == value:
+                break
+        else:
+            return False
+    return True
+
+
+class SymmetricKeyResolver():
+    """Resolves SSGP labels to unwrapped symmetric keys.
+
+    Symmetric key records are indexed by their 20 byte label without decrypting them. A key is unwrapped
+    the first time a SSGP blob references its label and memoized for the rest of the run.
+    """
+
+    def __init__(self, keychain):
+        self.keychain = keychain
+        self.key_index = None
+        self.key_list = {}  # label -> unwrapped key, '' if unwrapping failed
+
+    ## symmetric key record offsets by SSGP label
+    def getKeyIndex(self):
+        if self.key_index is None:
+            key_index = {}
+            try:
+                table_offset = self.keychain.getTableOffset(CSSM_DL_DB_RECORD_SYMMETRIC_KEY)
+                TableMetadata, symmetrickey_list = self.keychain.getTable(table_offset)
+            except KeyError:
+                symmetrickey_list = []
+
+            for symmetrickey_record in symmetrickey_list:
+                keyblob, ciphertext, iv, return_value = self.keychain.getKeyblobRecord(table_offset,
+                                                                                      symmetrickey_record)
+                if return_value == 0:
+                    key_index[keyblob] = symmetrickey_record
+            self.key_index = key_index
+
+        return self.key_index
+
+    def resolve(self, label):
+        if label not in self.key_list:
+            try:
+                symmetrickey_record = self.getKeyIndex()[label]
+            except KeyError:
+                return ''
+            keyblob, ciphertext, iv, return_value = self.keychain.getKeyblobRecord(
+                self.keychain.getTableOffset(CSSM_DL_DB_RECORD_SYMMETRIC_KEY), symmetrickey_record)
+            self.key_list[label] = self.keychain.KeyblobDecryption(ciphertext, iv, self.keychain.dbkey)
+
+        return self.key_list[label]
+
+    ## how many indexed keys were unwrapped, failed to unwrap or were never needed
+    def getStats(self):
+        total = len(self.getKeyIndex())
+        unwrapped = len([key for key in self.key_list.values() if key != ''])
+        failed = len(self.key_list) - unwrapped
+
+        return {'total': total, 'unwrapped': unwrapped, 'failed': failed, 'skipped': total - len(self.key_list)}
+
+
 class KeyChain():
     def __init__(self, filepath):
         self.filepath = filepath
         self.fbuf = ''
+        self.dbkey = ''
+        self.table_list = None
+        self.table_enum = None
+        self.key_resolver = SymmetricKeyResolver(self)
+        self.record_index = None
+        self.plaintext_cache = None  # optional PlaintextCache for SSGP items and private keys
+        self.key_cache = None  # optional KeyCache of password derived database keys
 
     def open(self):
         try:
@@ -342,29 +524,33 @@ class KeyChain():
         return _schemainfo, table_list
 
     def getTable(self, offset):
-        record_list = []
         BASE_ADDR = sizeof(_APPL_DB_HEADER) + offset
 
         TableMetaData = _memcpy(self.fbuf[BASE_ADDR:BASE_ADDR + sizeof(_TABLE_HEADER)], _TABLE_HEADER)
 
         RECORD_OFFSET_BASE = BASE_ADDR + sizeof(_TABLE_HEADER)
 
-        record_count = 0
-        offset = 0
-        while TableMetaData.RecordCount != record_count:
-            RecordOffset = struct.unpack('>I', self.fbuf[
-                                               RECORD_OFFSET_BASE + (ATOM_SIZE * offset):RECORD_OFFSET_BASE + (
-                                                       ATOM_SIZE * offset) + ATOM_SIZE])[0]
-            # if len(record_list) >= 1:
-            #     if record_list[len(record_list)-1] >= RecordOffset:
-            #         continue
-            if (RecordOffset != 0x00) and (RecordOffset % 4 == 0):
-                record_list.append(RecordOffset)
-                # print ' [-] Record Offset: 0x%.8x'%RecordOffset
-                record_count += 1
-            offset += 1
-
-        return TableMetaData, record_list
+        # the record offset array never extends past the end of the table (or the file)
+        TABLE_END = min(BASE_ADDR + TableMetaData.TableSize, len(self.fbuf))
+        max_slots = max(TABLE_END - RECORD_OFFSET_BASE, 0) / ATOM_SIZE
+
+        slot_count = TableMetaData.RecordNumbersCount
+        if slot_count == 0 or slot_count > max_slots:
+            slot_count = max_slots
+
+        # one big endian unpack of the whole array, independent of the size of a C int
+        slots = struct.unpack('>%dI' % slot_count,
+                              self.fbuf[RECORD_OFFSET_BASE:RECORD_OFFSET_BASE + (ATOM_SIZE * slot_count)])
+
+        # free slots are zero, and valid offsets are atom aligned
+        record_list = [RecordOffset for RecordOffset in slots if RecordOffset and not RecordOffset & 3]
+
+        if len(record_list) < TableMetaData.RecordCount:
+            raise ValueError('table 0x%.8x at offset 0x%.8x declares %d records, but only %d valid record offsets '
+                             'were found' % (TableMetaData.TableId, BASE_ADDR, TableMetaData.RecordCount,
+                                             len(record_list)))
+
+        return TableMetaData, record_list[:TableMetaData.RecordCount]
 
     def getTablenametoList(self, recordList, tableList):
         TableDic = {}
@@ -374,6 +560,297 @@ class KeyChain():
 
         return len(recordList), TableDic
 
+    ## table offsets and record type -> table index, read once per keychain
+    def getTableDirectory(self):
+        if self.table_enum is None:
+            SchemaInfo, table_list = self.getSchemaInfo(self.getHeader().SchemaOffset)
+            TableMetadata, RecordList = self.getTable(table_list[0])
+            tableCount, self.table_enum = self.getTablenametoList(RecordList, table_list)
+            self.table_list = table_list
+
+        return self.table_list, self.table_enum
+
+    ## offset of a table by record type, raises KeyError if the keychain has no such table
+    def getTableOffset(self, record_type):
+        table_list, table_enum = self.getTableDirectory()
+        return table_list[table_enum[record_type]]
+
+    def unlock(self, password=None, masterkey=None, unlockfile=None):
+        """Derive the database key from a password, a hex encoded master key or a SystemKey unlock file.
+
+        Returns True if the key material opens the keychain.
+        """
+        metadata_offset = self.getTableOffset(CSSM_DL_DB_RECORD_METADATA)
+
+        if password is not None:
+            if self.key_cache is not None:
+                dbkey = self.key_cache.get(self.getDBBlobID(metadata_offset), password)
+                if dbkey is not None:
+                    self.dbkey = dbkey
+                    self.key_resolver = SymmetricKeyResolver(self)
+                    return True
+
+            master = self.generateMasterKey(password, metadata_offset)
+        elif masterkey is not None:
+            master = unhexlify(masterkey)
+        elif unlockfile is not None:
+            with open(unlockfile, mode='rb') as uf:
+                filecontent = uf.read()
+            master = _memcpy(filecontent, _UNLOCK_BLOB).masterKey
+        else:
+            raise ValueError('password, masterkey or unlockfile is required')
+
+        if len(master) != KEYLEN:
+            return False
+
+        self.dbkey = self.findWrappingKey(master, metadata_offset)
+        self.key_resolver = SymmetricKeyResolver(self)
+
+        if password is not None and self.key_cache is not None and len(self.dbkey) != 0:
+            self.key_cache.put(self.getDBBlobID(metadata_offset), password, self.dbkey)
+
+        return len(self.dbkey) != 0
+
+    ## unwrap the symmetric key of a SSGP label on first use, '' if there is none
+    def getSymmetricKey(self, label):
+        return self.key_resolver.resolve(label)
+
+    ## decode a single record of a table
+    def getRecord(self, table, record_offset):
+        return getattr(self, RECORD_PARSERS[table])(self.getTableOffset(table), record_offset)
+
+    ## fill in the secret of a single record, unwrapping only the key it references
+    def decryptRecord(self, table, record):
+        if table in SSGP_TABLES or table == CSSM_DL_DB_RECORD_PRIVATE_KEY:
+            if len(self.dbkey) == 0:
+                raise ValueError('keychain is locked')
+
+        if table in SSGP_TABLES:
+            real_key = self.getSymmetricKey(record.SSGP[0:20])
+            if real_key != '':
+                passwd = self.SSGPDecryption(record.SSGP, real_key)
+            else:
+                passwd = ''
+            return record._replace(Password=passwd)
+
+        if table == CSSM_DL_DB_RECORD_PRIVATE_KEY:
+            keyname, privatekey = self.PrivateKeyDecryption(record.Key, record.IV, self.dbkey)
+            return record._replace(KeyName=keyname, PrivateKey=privatekey)
+
+        return record
+
+    def iter_records(self, table, record_offsets=None, **filters):
+        """Yield the decoded records of a table (a CSSM_DL_DB_RECORD_* type) one at a time.
+
+        service=, account=, server= and label= keep only the records whose attribute matches exactly.
+        record_offsets optionally restricts the table to these records (see diffTable).
+        Raises KeyError if the keychain has no such table.
+        """
+        if record_offsets is None:
+            TableMetadata, record_offsets = self.getTable(self.getTableOffset(table))
+
+        for record_offset in record_offsets:
+            record = self.getRecord(table, record_offset)
+            if _matchfilters(record, filters):
+                yield record
+
+    def iter_attributes(self, table, **filters):
+        """Like iter_records, without the encrypted blobs, secrets and certificate data (ATTRIBUTE_TYPES records).
+
+        Nothing is decrypted, the keychain does not need to be unlocked.
+        """
+        attribute_type = ATTRIBUTE_TYPES[table]
+        for record in self.iter_records(table, **filters):
+            yield attribute_type._make(getattr(record, field) for field in attribute_type._fields)
+
+    def iter_decrypted(self, table, jobs=1, record_offsets=None, pool=None, **filters):
+        """Like iter_records, with the Password (SSGP tables) or KeyName/PrivateKey (private keys) filled in.
+
+        Filters are applied to the plaintext attributes first, so records they skip are never decrypted.
+        With jobs > 1 records are decoded and decrypted by a pool of worker processes and still yielded
+        in table order, on pool (from openPool()) if given, else on a pool of their own. The keychain must be
+        unlocked first.
+        """
+        if jobs <= 1:
+            for record in self.iter_records(table, record_offsets, **filters):
+                yield self.decryptRecord(table, record)
+            return
+
+        if record_offsets is None:
+            TableMetadata, record_offsets = self.getTable(self.getTableOffset(table))
+        tasks = [(table, record_offset, filters) for record_offset in record_offsets]
+
+        own_pool = pool is None
+        if own_pool:
+            pool = self.openPool(jobs)
+        try:
+            chunksize = max(1, len(tasks) / (jobs * 4))
+            for record, unwrapped, cache_counts, stats in pool.imap(_pooldecrypt, tasks, chunksize):
+                self.key_resolver.key_list.update(unwrapped)
+                if stats is not None:
+                    _stats.merge(stats)
+                if self.plaintext_cache is not None:
+                    self.plaintext_cache.hits += cache_counts[0]
+                    self.plaintext_cache.misses += cache_counts[1]
+                if record is not None:
+                    yield record
+            if own_pool:
+                pool.close()
+        finally:
+            if own_pool:
+                pool.terminate()
+                pool.join()
+
+    def openPool(self, jobs):
+        """Pool of jobs worker processes for iter_decrypted(), to be shared by all its tables.
+
+        The workers are forked now, after the keychain is loaded and unlocked, so they share the keychain buffer
+        copy-on-write and only (table, record offset) tasks are sent to them. Open it before starting any thread:
+        a fork while other threads hold locks can deadlock the workers.
+        """
+        import multiprocessing
+
+        return multiprocessing.Pool(jobs, _initpool, (self,))
+
+    ## RecordNumber and [RecordSize, ModDate, digest of the record bytes] of a record, without decoding it
+    def getRecordSignature(self, table, record_offset):
+        BASE_ADDR = sizeof(_APPL_DB_HEADER) + self.getTableOffset(table) + record_offset
+
+        RecordSize, RecordNumber = struct.unpack('>II', self.fbuf[BASE_ADDR:BASE_ADDR + 8])
+
+        ModDate = ''
+        if table in SSGP_TABLES:  # the password record headers share the ModDate column
+            pCol = self.getInt(BASE_ADDR, _GENERIC_PW_HEADER.ModDate.offset) & 0xFFFFFFFE
+            if pCol > 0:
+                ModDate = self.fbuf[BASE_ADDR + pCol:BASE_ADDR + pCol + SIZEOFKEYCHAINTIME].rstrip('\x00')
+                ModDate = ModDate.encode('string_escape')  # kept in a JSON sidecar
+
+        # the record bytes cover the SSGP blob or key blob as well as every attribute
+        digest = hashlib.sha1(self.fbuf[BASE_ADDR:BASE_ADDR + RecordSize]).hexdigest()
+
+        return RecordNumber, [RecordSize, ModDate, digest]
+
+    def diffTable(self, table, previous):
+        """Compare the records of a table with their signatures from an earlier run.
+
+        previous maps RecordNumber to the getRecordSignature() of that run. Returns the current signatures,
+        the offsets of the added and modified records in table order, how many records were added and the
+        RecordNumbers of the deleted records. Raises KeyError if the keychain has no such table.
+        """
+        TableMetadata, record_list = self.getTable(self.getTableOffset(table))
+
+        signatures = {}
+        changed = []
+        added = 0
+        for record_offset in record_list:
+            RecordNumber, signature = self.getRecordSignature(table, record_offset)
+            signatures[RecordNumber] = signature
+            if RecordNumber not in previous:
+                changed.append(record_offset)
+                added += 1
+            elif previous[RecordNumber] != signature:
+                changed.append(record_offset)
+
+        deleted = sorted(set(previous) - set(signatures))
+
+        return signatures, changed, added, deleted
+
+    def iter_identities(self, **filters):
+        """Yield (certificate, public key, private key) records that belong together, without decrypting anything.
+
+        Apple keychains store the public key hash of a certificate in its PublicKeyHash attribute and the same
+        hash in the Label attribute of the key pair, so identities are joined on those. The filters apply to the
+        certificate. The public key is None if the keychain has no such record; the private key is not decrypted,
+        pass it to decryptRecord() for its PrivateKey.
+        """
+        keys = {}
+        for table in (CSSM_DL_DB_RECORD_PUBLIC_KEY, CSSM_DL_DB_RECORD_PRIVATE_KEY):
+            try:
+                for record in self.iter_records(table):
+                    keys.setdefault((table, _publickeyhash(record)), []).append(record)
+            except KeyError:
+                pass
+
+        try:
+            certificates = self.iter_records(CSSM_DL_DB_RECORD_X509_CERTIFICATE, **filters)
+            for certificate in certificates:
+                publickeyhash = _publickeyhash(certificate)
+                if publickeyhash == '':
+                    continue
+                public_key = keys.get((CSSM_DL_DB_RECORD_PUBLIC_KEY, publickeyhash), [None])[0]
+                for private_key in keys.get((CSSM_DL_DB_RECORD_PRIVATE_KEY, publickeyhash), []):
+                    yield certificate, public_key, private_key
+        except KeyError:
+            return
+
+    ## (table, RecordNumber) -> record offset and (attribute, value) -> set of (table, record offset), built once
+    def getRecordIndex(self):
+        if self.record_index is None:
+            by_number = {}
+            by_attribute = {}
+            table_list, table_enum = self.getTableDirectory()
+
+            for table in RECORD_PARSERS:
+                if table not in table_enum:
+                    continue
+                TableMetadata, record_list = self.getTable(self.getTableOffset(table))
+                for record_offset in record_list:
+                    record = self.getRecord(table, record_offset)
+                    by_number[(table, record.RecordNumber)] = record_offset
+                    for attribute, fields in INDEXED_ATTRIBUTES.items():
+                        for field in fields:
+                            if field not in record._fields:
+                                continue
+                            value = _indexvalue(getattr(record, field))
+                            if value != '':
+                                by_attribute.setdefault((attribute, value), set()).add((table, record_offset))
+            self.record_index = by_number, by_attribute
+
+        return self.record_index
+
+    def get_record(self, table, record_number, decrypt=True):
+        """Return the record of a table with the given RecordNumber, decrypting only that record.
+
+        Raises KeyError if there is no such record.
+        """
+        by_number, by_attribute = self.getRecordIndex()
+        record = self.getRecord(table, by_number[(table, record_number)])
+
+        if decrypt:
+            return self.decryptRecord(table, record)
+        return record
+
+    def find_records(self, table=None, decrypt=True, **attributes):
+        """Return the records matching all given attributes (service, account, server, label).
+
+        Only the matching records are decrypted. table optionally restricts the search to one record type.
+        """
+        if len(attributes) == 0:
+            raise TypeError('find_records() needs at least one of: %s' % ', '.join(sorted(INDEXED_ATTRIBUTES)))
+
+        by_number, by_attribute = self.getRecordIndex()
+
+        matches = None
+        for attribute, value in attributes.items():
+            if attribute not in INDEXED_ATTRIBUTES:
+                raise TypeError('find_records() got an unexpected attribute %r' % attribute)
+            found = by_attribute.get((attribute, _indexvalue(value)), set())
+            if matches is None:
+                matches = found
+            else:
+                matches = matches & found
+
+        records = []
+        for record_table, record_offset in sorted(matches):
+            if table is not None and record_table != table:
+                continue
+            record = self.getRecord(record_table, record_offset)
+            if decrypt:
+                record = self.decryptRecord(record_table, record)
+            records.append(record)
+
+        return records
+
     def getKeyblobRecord(self, base_addr, offset):
 
         BASE_ADDR = sizeof(_APPL_DB_HEADER) + base_addr + offset
@@ -397,7 +874,8 @@ class KeyChain():
         ciphertext = record[KeyBlobRecord.startCryptoBlob:KeyBlobRecord.totalLength]
 
         # match data, keyblob_ciphertext, Initial Vector, success
-        return record[KeyBlobRecord.totalLength + 8:KeyBlobRecord.totalLength + 8 + 20], ciphertext, KeyBlobRecord.iv, 0
+        return record[KeyBlobRecord.totalLength + 8:KeyBlobRecord.totalLength + 8 + 20], ciphertext, \
+               record[_KEY_BLOB.iv.offset:sizeof(_KEY_BLOB)], 0
 
     def getGenericPWRecord(self, base_addr, offset):
         record = []
@@ -427,7 +905,10 @@ class KeyChain():
         record.append(self.getLV(BASE_ADDR, RecordMeta.Account & 0xFFFFFFFE))
         record.append(self.getLV(BASE_ADDR, RecordMeta.Service & 0xFFFFFFFE))
 
-        return record
+        record.append(RecordMeta.RecordNumber)
+        record.append('')  # Password, filled in by iter_decrypted
+
+        return GenericPasswordRecord._make(record)
 
     def getInternetPWRecord(self, base_addr, offset):
         record = []
@@ -467,7 +948,10 @@ class KeyChain():
 
         record.append(self.getLV(BASE_ADDR, RecordMeta.Path & 0xFFFFFFFE))
 
-        return record
+        record.append(RecordMeta.RecordNumber)
+        record.append('')  # Password, filled in by iter_decrypted
+
+        return InternetPasswordRecord._make(record)
 
     def getx509Record(self, base_addr, offset):
         record = []
@@ -491,7 +975,9 @@ class KeyChain():
         record.append(self.getLV(BASE_ADDR, RecordMeta.PublicKeyHash & 0xFFFFFFFE))
 
         record.append(x509Certificate)
-        return record
+        record.append(RecordMeta.RecordNumber)
+
+        return X509CertificateRecord._make(record)
 
     def getKeyRecord(self, base_addr, offset):  ## PUBLIC and PRIVATE KEY
         record = []
@@ -516,7 +1002,11 @@ class KeyChain():
         record.append(IV)
         record.append(Key)
 
-        return record
+        record.append(RecordMeta.RecordNumber)
+        record.append('')  # KeyName and
+        record.append('')  # PrivateKey, filled in by iter_decrypted for private keys
+
+        return KeyRecord._make(record)
 
     def getEncryptedDatainBlob(self, BlobBuf):
         KeyBlob = _memcpy(BlobBuf[:sizeof(_KEY_BLOB)], _KEY_BLOB)
@@ -525,7 +1015,7 @@ class KeyChain():
             return '', ''
 
         KeyData = BlobBuf[KeyBlob.startCryptoBlob:KeyBlob.totalLength]
-        return KeyBlob.iv, KeyData  # IV, Encrypted Data
+        return BlobBuf[_KEY_BLOB.iv.offset:sizeof(_KEY_BLOB)], KeyData  # IV, Encrypted Data
 
     def getKeychainTime(self, BASE_ADDR, pCol):
         if pCol <= 0:
@@ -599,14 +1089,27 @@ class KeyChain():
         record.append(self.getLV(BASE_ADDR, RecordMeta.Address & 0xFFFFFFFE))
         record.append(self.getLV(BASE_ADDR, RecordMeta.Signature & 0xFFFFFFFE))
 
-        return record
+        record.append(RecordMeta.RecordNumber)
+        record.append('')  # Password, filled in by iter_decrypted
+
+        return AppleSharePasswordRecord._make(record)
 
     ## decrypted dbblob area
     ## Documents : http://www.opensource.apple.com/source/securityd/securityd-55137.1/doc/BLOBFORMAT
     ## http://www.opensource.apple.com/source/libsecurity_keychain/libsecurity_keychain-36620/lib/StorageManager.cpp
     def SSGPDecryption(self, ssgp, dbkey):
-        SSGP = _memcpy(ssgp, _SSGP)
-        plain = kcdecrypt(dbkey, SSGP.iv, ssgp[sizeof(_SSGP):])
+        iv = ssgp[_SSGP.iv.offset:sizeof(_SSGP)]
+        ciphertext = ssgp[sizeof(_SSGP):]
+
+        if self.plaintext_cache is not None:
+            plain = self.plaintext_cache.get(dbkey, iv, ciphertext)
+            if plain is not None:
+                return plain
+
+        plain = kcdecrypt(dbkey, iv, ciphertext)
+
+        if self.plaintext_cache is not None and plain != '':
+            self.plaintext_cache.put(dbkey, iv, ciphertext, plain)
 
         return plain
 
@@ -623,9 +1126,7 @@ class KeyChain():
 
         # now we handle the unwrapping. we need to take the first 32 bytes,
         # and reverse them.
-        revplain = ''
-        for i in range(32):
-            revplain += plain[31 - i]
+        revplain = plain[31::-1]
 
         # now the real key gets found. */
         plain = kcdecrypt(dbkey, iv, revplain)
@@ -641,33 +1142,47 @@ class KeyChain():
     # test code
     # http://opensource.apple.com/source/libsecurity_keychain/libsecurity_keychain-55044/lib/KeyItem.cpp
     def PrivateKeyDecryption(self, encryptedblob, iv, dbkey):
+        if self.plaintext_cache is not None:
+            plain = self.plaintext_cache.get(dbkey, iv, encryptedblob)
+            if plain is not None:
+                return plain[:12], plain[12:]
+
         magicCmsIV = unhexlify('4adda22c79e82105')
         plain = kcdecrypt(dbkey, magicCmsIV, encryptedblob)
 
         if plain.__len__() == 0:
             return '', ''
 
-        # now we handle the unwrapping. we need to take the first 32 bytes,
-        # and reverse them.
-        revplain = ''
-        for i in range(len(plain)):
-            revplain += plain[len(plain) - 1 - i]
+        # now we handle the unwrapping. we need to take the whole buffer,
+        # and reverse it.
+        revplain = plain[::-1]
 
         # now the real key gets found. */
         plain = kcdecrypt(dbkey, iv, revplain)
 
+        if self.plaintext_cache is not None and plain != '':
+            self.plaintext_cache.put(dbkey, iv, encryptedblob, plain)
+
         Keyname = plain[:12]  # Copied Buffer when user click on right and copy a key on Keychain Access
         keyblob = plain[12:]
 
         return Keyname, keyblob
 
+    ## DBBlob salt and randomSignature, identifying a keychain's key derivation
+    def getDBBlobID(self, symmetrickey_offset):
+        base_addr = sizeof(_APPL_DB_HEADER) + symmetrickey_offset + 0x38
+        salt = self.fbuf[base_addr + _DB_BLOB.salt.offset:base_addr + _DB_BLOB.salt.offset + _DB_BLOB.salt.size]
+        signature = self.fbuf[base_addr + _DB_BLOB.randomSignature.offset:
+                              base_addr + _DB_BLOB.randomSignature.offset + _DB_BLOB.randomSignature.size]
+        return salt + signature
+
     ## Documents : http://www.opensource.apple.com/source/securityd/securityd-55137.1/doc/BLOBFORMAT
     def generateMasterKey(self, pw, symmetrickey_offset):
 
         base_addr = sizeof(_APPL_DB_HEADER) + symmetrickey_offset + 0x38  # header
-        dbblob = _memcpy(self.fbuf[base_addr:base_addr + sizeof(_DB_BLOB)], _DB_BLOB)
+        salt = self.fbuf[base_addr + _DB_BLOB.salt.offset:base_addr + _DB_BLOB.salt.offset + _DB_BLOB.salt.size]
 
-        masterkey = pbkdf2(pw, str(bytearray(dbblob.salt)), 1000, KEYLEN)
+        masterkey = pbkdf2(pw, salt, 1000, KEYLEN)
         return masterkey
 
     ## find DBBlob and extract Wrapping key
@@ -681,7 +1196,8 @@ class KeyChain():
         ciphertext = self.fbuf[base_addr + dbblob.startCryptoBlob:base_addr + dbblob.totalLength]
 
         # decrypt the key
-        plain = kcdecrypt(master, dbblob.iv, ciphertext)
+        plain = kcdecrypt(master, self.fbuf[base_addr + _DB_BLOB.iv.offset:base_addr + _DB_BLOB.iv.offset + _DB_BLOB.iv.size],
+                          ciphertext)
 
         if plain.__len__() < KEYLEN:
             return ''
@@ -692,6 +1208,48 @@ class KeyChain():
         return dbkey
 
 
+# keychain of a --jobs worker process
+_pool_keychain = None
+
+
+def _initpool(keychain):
+    global _pool_keychain
+    _pool_keychain = keychain
+
+
+## decode and decrypt one record in a worker
+## returns the record (None if filtered out), newly unwrapped keys, plaintext cache (hits, misses) and the
+## Stats report of the task with --stats
+def _pooldecrypt(task):
+    table, record_offset, filters = task
+    key_list = _pool_keychain.key_resolver.key_list
+    cache = _pool_keychain.plaintext_cache
+    if _stats is not None:
+        _stats.clear()
+
+    record = _pool_keychain.getRecord(table, record_offset)
+    if not _matchfilters(record, filters):
+        return None, {}, (0, 0), _stats and _stats.report()
+
+    known = set(key_list)
+    if cache is not None:
+        hits, misses = cache.hits, cache.misses
+
+    record = _pool_keychain.decryptRecord(table, record)
+
+    if cache is not None:
+        cache_counts = (cache.hits - hits, cache.misses - misses)
+    else:
+        cache_counts = (0, 0)
+
+    return (record, dict((label, key) for label, key in key_list.items() if label not in known), cache_counts,
+            _stats and _stats.report())
+
+
+# Stats of a --stats run, counts the blocks kcdecrypt() decrypts and its padding failures
+_stats = None
+
+
 # SOURCE : extractkeychain.py
 def kcdecrypt(key, iv, data):
     if len(data) == 0:
@@ -702,24 +1260,32 @@ def kcdecrypt(key, iv, data):
         return ''
 
 
-    cipher = triple_des(key, CBC, str(bytearray(iv)))
+    if not isinstance(iv, str):
+        iv = str(bytearray(iv))
+
+    cipher = triple_des(key, CBC, iv)
 
     # the line below is for pycrypto instead
     # cipher = DES3.new( key, DES3.MODE_CBC, iv )
 
     plain = cipher.decrypt(data)
+    if _stats is not None:
+        _stats.count('blocks decrypted', len(data) / BLOCKSIZE)
 
     # now check padding
     pad = ord(plain[-1])
     if pad > 8:
         # print>> stderr, "Bad padding byte. You probably have a wrong password"
+        if _stats is not None:
+            _stats.count('padding failures')
         return ''
 
 
-    for z in plain[-pad:]:
-        if ord(z) != pad:
-            # print>> stderr, "Bad padding. You probably have a wrong password"
-            return ''
+    if plain[-pad:] != plain[-1] * pad:
+        # print>> stderr, "Bad padding. You probably have a wrong password"
+        if _stats is not None:
+            _stats.count('padding failures')
+        return ''
 
     plain = plain[:-pad]
 
@@ -728,39 +1294,656 @@ def kcdecrypt(key, iv, data):
 
 BASEPATH = os.getcwd() + '/exported/'
 
-if not os.path.exists(BASEPATH):
-    os.makedirs(BASEPATH)
 
+## where certificates and keys go: BASEPATH, or a single tar/zip archive
+def open_export(archive=None):
+    from export import ArchiveExport, DirectoryExport
+
+    if archive is not None:
+        return ArchiveExport(archive)
+    return DirectoryExport(BASEPATH)
+
+
+# output order of the record tables
+TABLE_ORDER = (
+    CSSM_DL_DB_RECORD_GENERIC_PASSWORD,
+    CSSM_DL_DB_RECORD_INTERNET_PASSWORD,
+    CSSM_DL_DB_RECORD_APPLESHARE_PASSWORD,
+    CSSM_DL_DB_RECORD_X509_CERTIFICATE,
+    CSSM_DL_DB_RECORD_PUBLIC_KEY,
+    CSSM_DL_DB_RECORD_PRIVATE_KEY,
+)
+
+TABLE_UNAVAILABLE = {
+    CSSM_DL_DB_RECORD_GENERIC_PASSWORD: '[!] Generic Password Table is not available',
+    CSSM_DL_DB_RECORD_INTERNET_PASSWORD: '[!] Internet Password Table is not available',
+    CSSM_DL_DB_RECORD_APPLESHARE_PASSWORD: '[!] AppleShare Table is not available',
+    CSSM_DL_DB_RECORD_X509_CERTIFICATE: '[!] Certification Table is not available',
+    CSSM_DL_DB_RECORD_PUBLIC_KEY: '[!] Public Key Table is not available',
+    CSSM_DL_DB_RECORD_PRIVATE_KEY: '[!] Private Key Table is not available',
+}
+
+RECORD_TYPES = {
+    CSSM_DL_DB_RECORD_GENERIC_PASSWORD: GenericPasswordRecord,
+    CSSM_DL_DB_RECORD_INTERNET_PASSWORD: InternetPasswordRecord,
+    CSSM_DL_DB_RECORD_APPLESHARE_PASSWORD: AppleSharePasswordRecord,
+    CSSM_DL_DB_RECORD_X509_CERTIFICATE: X509CertificateRecord,
+    CSSM_DL_DB_RECORD_PUBLIC_KEY: KeyRecord,
+    CSSM_DL_DB_RECORD_PRIVATE_KEY: KeyRecord,
+}
+
+
+# every field of every record type, in table order, as columns of --format csv
+RECORD_COLUMNS = []
+for table in TABLE_ORDER:
+    RECORD_COLUMNS.extend(field for field in RECORD_TYPES[table]._fields if field not in RECORD_COLUMNS)
+
+
+# the same for the attribute only records of --triage
+TRIAGE_COLUMNS = [column for column in RECORD_COLUMNS if column not in BLOB_FIELDS]
+
+
+def make_writer(format, stream=None, secret_encoding='hex', columns=RECORD_COLUMNS):
+    table_names = dict((table, name) for name, table in TABLE_NAMES.items())
+    if format == 'text':
+        return TextWriter(stream)
+    if format == 'csv':
+        return CsvWriter(stream, table_names, secret_encoding, columns=columns)
+    return WRITERS[format](stream, table_names, secret_encoding)
+
+
+## --triage: [(table, attribute record)] of a keychain, without decrypting anything
+def triage(keychain, tables=TABLE_ORDER, filters={}):
+    results = []
+    for table in TABLE_ORDER:
+        if table not in tables:
+            continue
+        try:
+            for record in keychain.iter_attributes(table, **filters):
+                results.append((table, record))
+        except KeyError:
+            pass
+    return results
+
+
+# estimated seconds of the steps of a --batch job (pure Python DES), for scheduling
+UNLOCK_COSTS = {'password': 0.05, 'masterkey': 0.005, 'unlockfile': 0.005}
+RECORD_COST = 0.02  # decryption of a record
+TRIAGE_RECORD_COST = 0.0001
+AVERAGE_RECORD_SIZE = 500  # bytes per record, when the table directory can not be read
+
+# jobs estimated to take longer get the job class 'long' (see --long-jobs)
+LONG_JOB = 60
+
+
+## record counts by table id, read from the table headers without loading the whole keychain
+def _recordcounts(path):
+    with open(path, 'rb') as f:
+        data = f.read(sizeof(_APPL_DB_HEADER) + sizeof(_APPL_DB_SCHEMA))
+        if len(data) < sizeof(_APPL_DB_HEADER) + sizeof(_APPL_DB_SCHEMA) or data[:4] != KEYCHAIN_SIGNATURE:
+            raise ValueError('not a keychain')
+        f.seek(_memcpy(data, _APPL_DB_HEADER).SchemaOffset)
+        schema = f.read(sizeof(_APPL_DB_SCHEMA))
+        if len(schema) < sizeof(_APPL_DB_SCHEMA):
+            raise ValueError('truncated schema')
+        table_count = _memcpy(schema, _APPL_DB_SCHEMA).TableCount
+
+        f.seek(sizeof(_APPL_DB_HEADER) + sizeof(_APPL_DB_SCHEMA))
+        table_list = struct.unpack('>%dI' % table_count, f.read(ATOM_SIZE * table_count))
+
+        counts = {}
+        for offset in table_list:
+            f.seek(sizeof(_APPL_DB_HEADER) + offset)
+            table = f.read(sizeof(_TABLE_HEADER))
+            if len(table) < sizeof(_TABLE_HEADER):
+                raise ValueError('truncated table header')
+            table = _memcpy(table, _TABLE_HEADER)
+            counts[table.TableId] = table.RecordCount
+        return counts
+
+
+## (job class, estimated seconds) of a --batch job, from its unlock kind and the record counts of its tables
+def _batchcost(path, material, tables=TABLE_ORDER, triage_only=False, long_job=LONG_JOB):
+    import batch
 
-def add_file(directory, filename='default', key=None, cert=None):
-    # print 'into function key={}, cert={}'.format(key, cert)
-    target_path = BASEPATH + directory
-    if not os.path.exists(target_path):
-        os.makedirs(target_path)
-    if key is not None:
-        with open(target_path + '/{}.key'.format(filename), 'w+') as f:
-            f.write(key)
-    if cert is not None:
-        with open(target_path + '/{}.crt'.format(filename), 'w+') as f:
-            f.write(cert)
+    try:
+        counts = _recordcounts(path)
+        records = sum(counts.get(table, 0) for table in tables)
+    except (IOError, ValueError, struct.error):
+        try:
+            records = os.path.getsize(path) / AVERAGE_RECORD_SIZE
+        except OSError:
+            records = 0
+
+    if triage_only:
+        return 'triage', records * TRIAGE_RECORD_COST
+
+    for kind in batch.UNLOCK_KINDS:  # in the order KeyChain.unlock() prefers them
+        if material.get(kind):
+            cost = UNLOCK_COSTS[kind] + records * RECORD_COST
+            return 'long' if cost > long_job else kind, cost
+    return 'no unlock material', 0.0
+
+
+## decrypt (or triage) a whole keychain for --batch, returns (status, [(table, record)])
+## records per chunk of a streamed job
+STREAM_CHUNK = 32
+
+
+## emit(results) gets the records in chunks of up to STREAM_CHUNK (and at the end of every table) as they are
+## decrypted, instead of all of them in the result
+def _batchprocess(path, material, tables=TABLE_ORDER, filters={}, data=None, triage_only=False, emit=None):
+    keychain = KeyChain(path)
+    if data is not None:
+        keychain.fbuf = data  # prefetched by the batch pipeline
+    elif not keychain.open():
+        return 'unreadable', []
+    if not keychain.checkValidKeychain():
+        return 'invalid', []
+    if triage_only:
+        try:
+            return 'ok', triage(keychain, tables, filters)
+        except ValueError:
+            return 'corrupted', []
+    if not material:
+        return 'no unlock material', []
+    if not keychain.unlock(**material):
+        return 'locked', []
+
+    results = []
+    for table in TABLE_ORDER:
+        if table not in tables:
+            continue
+        try:
+            for record in keychain.iter_decrypted(table, **filters):
+                results.append((table, record))
+                if emit is not None and len(results) == STREAM_CHUNK:
+                    emit(results)
+                    results = []
+        except KeyError:
+            pass
+        if emit is not None and results:
+            emit(results)
+            results = []
+
+    return 'ok', results
+
+
+def run_batch(args, tables, filters, output):
+    """--batch: decrypt every keychain below a directory on a worker pool into one result set"""
+    import batch
+
+    if args.password is not None:
+        default = {'password': args.password[0]}
+    elif args.key is not None:
+        default = {'masterkey': args.key[0]}
+    elif args.unlockfile is not None:
+        default = {'unlockfile': os.path.abspath(args.unlockfile[0])}
+    else:
+        default = {}
+
+    manifest = {}
+    if args.manifest is not None:
+        manifest = batch.load_manifest(args.manifest[0])
+
+    jobs = []
+    for path in batch.discover(args.batch[0]):
+        jobs.append((path, manifest.get(os.path.normpath(os.path.abspath(path)), default)))
+
+    columns = TRIAGE_COLUMNS if args.triage else RECORD_COLUMNS
+    writer = make_writer(args.format, output, args.secret_encoding, columns=['keychain'] + columns)
+    process = functools.partial(_batchprocess, tables=tables, filters=filters, triage_only=args.triage)
+    estimate = functools.partial(_batchcost, tables=tables, triage_only=args.triage, long_job=args.long_job)
+    limits = {'long': max(1, int(args.jobs * args.long_jobs))}
+
+    # one SQLite run per keychain
+    exporter = None
+    if args.exportfile is not None:
+        exporter = make_exporter(args.exportfile[0])
+
+    counts = {'ok': 0, 'failed': 0, 'records': 0}
+    classes = {}  # job class -> [jobs, seconds waited, longest wait, seconds run]
+    for path, status, error, records, seconds, job_class, waited in batch.run(process, jobs, args.jobs, args.timeout,
+                                                                               estimate=estimate, limits=limits):
+        stats = classes.setdefault(job_class, [0, 0.0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += waited
+        stats[2] = max(stats[2], waited)
+        stats[3] += seconds
+
+        if status == 'ok':
+            counts['ok'] += 1
+            writer.status('[+] Keychain %s: %d records (%.2fs)' % (path, len(records), seconds))
+        else:
+            counts['failed'] += 1
+            writer.status('[!] Keychain %s: %s%s' % (path, status, ': ' + error if error else ''))
+
+        writer.context['keychain'] = path
+        for table, record in records:
+            writer.write_record(table, record)
+        counts['records'] += len(records)
+
+        if exporter is not None and status == 'ok':
+            exporter.begin(keychain=os.path.abspath(path), tables=json.dumps(sorted(args.tables or TABLE_NAMES)),
+                           filters=json.dumps(filters, sort_keys=True))
+            for table, record in records:
+                exporter.write_record(table, record)
+            exporter.end()
+
+    writer.status('[+] Batch: %d keychains, %d ok, %d failed, %d records' % (
+        len(jobs), counts['ok'], counts['failed'], counts['records']))
+    for job_class in sorted(classes):
+        count, waited, longest, seconds = classes[job_class]
+        writer.status(' [-] %s: %d jobs, waited %.2fs on average (%.2fs at most), ran %.2fs on average' % (
+            job_class, count, waited / count, longest, seconds / count))
+    writer.close()
+    if exporter is not None:
+        exporter.close()
+
+
+## batch process function of a --serve job, ValueError for unknown tables
+def _serviceprocess(job):
+    tables = TABLE_ORDER
+    if job.get('tables'):
+        try:
+            tables = [TABLE_NAMES[name] for name in job['tables']]
+        except KeyError as e:
+            raise ValueError('unknown table %s' % e)
+    if job.get('secret_encoding', 'hex') not in SECRET_ENCODINGS:
+        raise ValueError('unknown secret encoding %r' % job['secret_encoding'])
+    filters = dict((attribute, str(job[attribute])) for attribute in INDEXED_ATTRIBUTES if job.get(attribute))
+    return functools.partial(_batchprocess, tables=tables, filters=filters)
+
+
+def _servicewriter(stream, job):
+    return make_writer('jsonl', stream, job.get('secret_encoding', 'hex'))
+
+
+def make_exporter(path):
+    table_names = dict((table, name) for name, table in TABLE_NAMES.items())
+    return SqliteExporter(path, table_names, RECORD_TYPES)
+
+
+class StageExporter:
+    """-x of a staged run. sqlite3 objects only work on the thread that created them, so the SqliteExporter is
+    created when the write stage writes the first record and closed by the finish() of that stage."""
+
+    def __init__(self, path, **provenance):
+        self.path = path
+        self.provenance = provenance
+        self.provenance.setdefault('started', datetime.datetime.utcnow().isoformat())  # not when it is opened
+        self.exporter = None
+
+    def open(self):
+        if self.exporter is None:
+            self.exporter = make_exporter(self.path)
+            self.exporter.begin(**self.provenance)
+        return self.exporter
+
+    def write_record(self, table, record):
+        self.open().write_record(table, record)
+
+    def close(self):
+        self.open().close()
+
+
+def associate(certs, keys, validator, verify=False):
+    """Pair exported certificates and private keys.
+
+    certs and keys are lists of (filename, DER data, public key hash attribute). Pairs are joined on the hash
+    attribute first; verify confirms every such candidate cryptographically. Certificates without a candidate
+    are matched against the remaining keys by public key fingerprint. Returns (cert filename, key filename) pairs.
+    """
+    by_hash = {}
+    for name, key, publickeyhash in keys:
+        if publickeyhash != '':
+            by_hash.setdefault(publickeyhash, []).append((name, key))
+
+    pairs = []
+    unmatched = []
+    paired_keys = set()
+    for name, cert, publickeyhash in certs:
+        candidates = by_hash.get(publickeyhash, []) if publickeyhash != '' else []
+        if verify and candidates:
+            fingerprint = validator.cert_fingerprint(cert)
+            candidates = [(key_name, key) for key_name, key in candidates
+                          if fingerprint is not None and validator.key_fingerprint(key) == fingerprint]
+        if not candidates:
+            unmatched.append((name, cert))
+        for key_name, key in candidates:
+            pairs.append((name, key_name))
+            paired_keys.add(key_name)
+
+    if unmatched:
+        pairs.extend(validator.match(unmatched, [(name, key) for name, key, publickeyhash in keys
+                                                 if name not in paired_keys]))
+
+    return pairs
+
+
+class IdentityMatcher:
+    """Match stage of a run: collects the exported certificates and private keys as they are decrypted.
+
+    The validator (pyOpenSSL) is loaded as soon as both have come along, and with verify every blob is
+    fingerprinted right away, so little of the matching is left once the keychain is decrypted.
+    """
+
+    def __init__(self, verify=False):
+        self.verify = verify
+        self.validator = None
+        self.certs = []  # (filename, DER data, public key hash attribute), as for associate()
+        self.keys = []
+        self.pairs = []
+
+    def add(self, item):
+        directory, filename, data, publickeyhash = item
+        if directory == 'certs':
+            self.certs.append((filename, data, publickeyhash))
+        else:
+            self.keys.append((filename, data, publickeyhash))
+
+        if self.validator is None:
+            if not self.certs or not self.keys:
+                return
+            from validator import Validator
+            self.validator = Validator()
+            if self.verify:  # everything added so far, this item included
+                for filename, cert, publickeyhash in self.certs:
+                    self.validator.cert_fingerprint(cert)
+                for filename, key, publickeyhash in self.keys:
+                    self.validator.key_fingerprint(key)
+            return
+
+        if self.verify:
+            if directory == 'certs':
+                self.validator.cert_fingerprint(data)
+            else:
+                self.validator.key_fingerprint(data)
+
+    ## (cert filename, key filename) pairs of everything added
+    def finish(self):
+        if self.validator is not None:
+            self.pairs = associate(self.certs, self.keys, self.validator, self.verify)
+
+
+def write_key_stats(writer, key_stats):
+    writer.status('[+] Symmetric Keys: %d unwrapped, %d skipped, %d failed (%d total)' % (
+        key_stats['unwrapped'], key_stats['skipped'], key_stats['failed'], key_stats['total']))
+
+
+## results of a run as plain tuples for the result cache, and back
+def encode_results(results, exports, key_stats):
+    encoded = []
+    for table, record in results:
+        if record is not None:
+            record = tuple(record)
+        encoded.append((table, record))
+    return encoded, exports, key_stats
+
+
+def decode_results(encoded):
+    encoded_results, exports, key_stats = encoded
+    results = []
+    for table, record in encoded_results:
+        if record is not None:
+            record = RECORD_TYPES[table]._make(record)
+        results.append((table, record))
+    return results, exports, key_stats
+
+
+## print and export the stored results of an earlier identical run
+def replay_results(writer, export_writer, results, exports, key_stats, exporter=None):
+    writer.status(' [-] DB Key')
+    writer.status('[+] Symmetric Key Table:')
+
+    for table, record in results:
+        if record is None:
+            writer.status(TABLE_UNAVAILABLE[table])
+        else:
+            writer.write_record(table, record)
+            if exporter is not None:
+                exporter.write_record(table, record)
+
+    write_key_stats(writer, key_stats)
+
+    for directory, filename, key, cert in exports:
+        export_writer.add_file(directory, filename, key=key, cert=cert)
+
+
+## print the --stats of the run, at exit
+def _writestats(format):
+    sys.stderr.write(_stats.format(format) + '\n')
 
 
 def main():
+    global _stats
+    import argparse
+    import multiprocessing
+
     parser = argparse.ArgumentParser(description='Tool for OS X Keychain Analysis by @n0fate')
-    parser.add_argument('-f', '--file', nargs=1, help='Keychain file(*.keychain)', required=True)
-    # parser.add_argument('-x', '--exportfile', nargs=1, help='Export a filename (SQLite, optional)', required=False)
-    group = parser.add_mutually_exclusive_group(required=True)
+    parser.add_argument('-f', '--file', nargs=1, help='Keychain file(*.keychain)', required=False)
+    parser.add_argument('-x', '--exportfile', nargs=1, help='Export a filename (SQLite, optional)', required=False)
+    group = parser.add_mutually_exclusive_group(required=False)
     group.add_argument('-k', '--key', nargs=1, help='Keychain Masterkey', required=False)
     group.add_argument('-u', '--unlockfile', nargs=1, help='System.keychain unlock file (/var/db/SystemKey)', required=False)
     group.add_argument('-p', '--password', nargs=1, help='Keychain Password', required=False)
+    parser.add_argument('--tables', nargs='+', choices=sorted(TABLE_NAMES), help='Only process these tables',
+                        required=False)
+    parser.add_argument('--service', nargs=1, help='Only records with this service', required=False)
+    parser.add_argument('--account', nargs=1, help='Only records with this account', required=False)
+    parser.add_argument('--server', nargs=1, help='Only records with this server', required=False)
+    parser.add_argument('--label', nargs=1, help='Only records with this label (PrintName or key Label)',
+                        required=False)
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Decrypt with N worker processes (default: 1, all cores with --batch)', required=False)
+    parser.add_argument('--batch', nargs=1, metavar='DIR',
+                        help='Process every keychain below DIR (found by signature) on a worker pool',
+                        required=False)
+    parser.add_argument('--manifest', nargs=1,
+                        help='CSV or JSON manifest of keychain path -> password/masterkey/unlockfile for --batch',
+                        required=False)
+    parser.add_argument('--timeout', type=int, default=None,
+                        help='Give up on a keychain of a --batch or --serve job after this many seconds',
+                        required=False)
+    parser.add_argument('--long-job', type=float, default=LONG_JOB, metavar='SECONDS',
+                        help='--batch jobs estimated to take longer are long jobs (default: %d)' % LONG_JOB,
+                        required=False)
+    parser.add_argument('--long-jobs', type=float, default=0.5, metavar='SHARE',
+                        help='Share of the workers long --batch jobs may occupy (default: 0.5)', required=False)
+    parser.add_argument('--serve', nargs=1, metavar='ADDRESS',
+                        help='Run as a service taking jobs over HTTP on HOST:PORT or on a Unix socket path',
+                        required=False)
+    parser.add_argument('--cache', nargs=1, help='Plaintext cache directory, reused across keychain snapshots',
+                        required=False)
+    parser.add_argument('--cache-size', type=int, default=256, help='Plaintext cache size limit in MB (default: 256)',
+                        required=False)
+    parser.add_argument('--key-cache', nargs=1, help='Cache directory for password derived keys, skips PBKDF2 on reruns',
+                        required=False)
+    parser.add_argument('--key-cache-ttl', type=int, default=3600,
+                        help='Seconds a cached password derived key stays valid (default: 3600)', required=False)
+    parser.add_argument('--result-cache', nargs=1,
+                        help='Result cache directory, unchanged keychains are answered without reprocessing',
+                        required=False)
+    parser.add_argument('--result-cache-entries', type=int, default=1000,
+                        help='Number of results kept in the result cache (default: 1000)', required=False)
+    parser.add_argument('--result-cache-refresh', action='store_true',
+                        help='Reprocess the keychain and replace its cached result', required=False)
+    parser.add_argument('--result-cache-clear', action='store_true',
+                        help='Empty the result cache before running', required=False)
+    parser.add_argument('--incremental', nargs='?', const='', metavar='SIDECAR',
+                        help='Only decrypt records added or modified since the last run and report deletions. '
+                             'Record signatures are kept in SIDECAR (default: <keychain>.cbindex)', required=False)
+    parser.add_argument('--format', choices=sorted(WRITERS), default=None,
+                        help='Output format of the records (default: text, jsonl with --triage)', required=False)
+    parser.add_argument('--secret-encoding', choices=sorted(SECRET_ENCODINGS), default='hex',
+                        help='Encoding of passwords and private keys in jsonl and csv output (default: hex)',
+                        required=False)
+    parser.add_argument('--export-archive', nargs=1, metavar='ARCHIVE',
+                        help='Write certificates and keys into one .tar, .tar.gz or .zip file instead of ./exported/',
+                        required=False)
+    parser.add_argument('--triage', action='store_true',
+                        help='Only list the record attributes (no secrets), needs no password or key',
+                        required=False)
+    parser.add_argument('--identities', action='store_true',
+                        help='List certificate/private key pairs from their attributes without decrypting anything',
+                        required=False)
+    parser.add_argument('--verify-identities', action='store_true',
+                        help='Confirm attribute matched certificate/private key pairs cryptographically',
+                        required=False)
+    parser.add_argument('-o', '--output', nargs=1, help='Write the records to this file instead of stdout',
+                        required=False)
+    parser.add_argument('--stats', nargs='?', const='text', choices=('text', 'json'),
+                        help='Print timers and counters of the run to stderr at exit (default: text)', required=False)
+    parser.add_argument('--profile', nargs=1, metavar='FILE', help='Write a cProfile (pstats) profile of the run',
+                        required=False)
     args = parser.parse_args()
 
+    if args.profile is not None:
+        import atexit
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        atexit.register(profiler.dump_stats, args.profile[0])
+
+    if args.stats is not None:
+        import atexit
+        from stats import Stats
+        _stats = Stats()
+        atexit.register(_writestats, args.stats)
+
+    if args.batch is None and args.serve is None:
+        if args.file is None:
+            parser.error('argument -f/--file is required')
+        if args.key is None and args.unlockfile is None and args.password is None \
+                and not args.triage and not args.identities:
+            parser.error('one of the arguments -k/--key -u/--unlockfile -p/--password is required')
+    elif args.batch is not None and args.password is None and args.key is None and args.unlockfile is None \
+            and args.manifest is None and not args.triage:
+        parser.error('--batch needs a --manifest or one of -k/--key -u/--unlockfile -p/--password')
+
+    if args.triage:
+        if args.format == 'text':
+            parser.error('--triage writes --format jsonl or csv')
+        if args.exportfile is not None or args.result_cache is not None or args.incremental is not None:
+            parser.error('--triage can not be combined with -x, --result-cache or --incremental')
+    if args.batch is not None:
+        # per keychain options the batch jobs do not implement
+        ignored = [option for option, value in (('--cache', args.cache), ('--key-cache', args.key_cache),
+                                                ('--result-cache', args.result_cache),
+                                                ('--incremental', args.incremental),
+                                                ('--identities', args.identities or None),
+                                                ('--export-archive', args.export_archive),
+                                                ('--verify-identities', args.verify_identities or None))
+                   if value is not None]
+        if ignored:
+            parser.error('--batch can not be combined with %s' % ', '.join(ignored))
+    if args.format is None:
+        args.format = 'jsonl' if args.triage else 'text'
+
+    if args.jobs is None:
+        args.jobs = 1 if args.batch is None and args.serve is None else multiprocessing.cpu_count()
+
+    if args.serve is not None:
+        # workers are forked now, with every module a job needs imported, and serve all jobs
+        from multiprocessing.queues import SimpleQueue
+        from service import Service, serve, _initworker
+
+        chunks = SimpleQueue()  # records of the running jobs, sent as they are decrypted
+        pool = multiprocessing.Pool(args.jobs, _initworker, (chunks,))
+        print '[+] Serving on %s with %d workers' % (args.serve[0], args.jobs)
+        sys.stdout.flush()
+        serve(args.serve[0], Service(pool, chunks, args.jobs, _serviceprocess, _servicewriter, args.timeout))
+        pool.terminate()
+        exit()
+
+    if args.incremental is not None and args.result_cache is not None:
+        parser.error('--incremental and --result-cache can not be combined')
+
+    if args.export_archive is not None:
+        from export import ARCHIVE_TYPES
+        if not args.export_archive[0].endswith(ARCHIVE_TYPES):
+            parser.error('--export-archive must end in one of %s' % ', '.join(ARCHIVE_TYPES))
+
+    if args.tables is not None:
+        tables = [TABLE_NAMES[name] for name in args.tables]
+    else:
+        tables = TABLE_NAMES.values()
+
+    filters = {}
+    for attribute in INDEXED_ATTRIBUTES:
+        if getattr(args, attribute) is not None:
+            filters[attribute] = getattr(args, attribute)[0]
+
+    if args.batch is not None:
+        if args.output is not None:
+            output = open(args.output[0], 'wb')
+        else:
+            output = sys.stdout
+        run_batch(args, tables, filters, output)
+        exit()
+
     if os.path.exists(args.file[0]) is False:
         print '[!] ERROR: Keychain is not exists'
         parser.print_help()
         exit()
 
+    # run provenance of the SQLite export
+    provenance = {
+        'keychain': os.path.abspath(args.file[0]),
+        'keychain_size': os.path.getsize(args.file[0]),
+        'unlocked_with': 'password' if args.password else 'masterkey' if args.key else 'unlockfile',
+        'tables': json.dumps(sorted(args.tables or TABLE_NAMES)),
+        'filters': json.dumps(filters, sort_keys=True),
+    }
+
+    if args.output is not None:
+        output = open(args.output[0], 'wb')
+    else:
+        output = sys.stdout
+
+    result_cache = None
+    if args.result_cache is not None:
+        from cache import ResultCache
+
+        result_cache = ResultCache(args.result_cache[0], args.result_cache_entries)
+        if args.result_cache_clear:
+            result_cache.clear()
+
+        fingerprint = result_cache.fingerprint(args.file[0])
+        if args.password is not None:
+            unlock_material = 'password', args.password[0]
+        elif args.key is not None:
+            unlock_material = 'masterkey', args.key[0].lower()
+        else:
+            with open(args.unlockfile[0], mode='rb') as uf:
+                unlock_material = 'unlockfile', uf.read()
+        # every flag that changes the stored records and exports: the identity check decides the associated pairs
+        # and the export destination their folder numbers. --format, --secret-encoding, -o and -x only change how
+        # the results are written, which replay_results() does anew
+        options = sorted(tables), sorted(filters.items()), args.verify_identities, args.export_archive is not None
+
+        if not args.result_cache_refresh:
+            cached = result_cache.get(fingerprint, unlock_material, options)
+            if cached is not None:
+                writer = make_writer(args.format, output, args.secret_encoding)
+                exporter = None
+                if args.exportfile is not None:
+                    exporter = make_exporter(args.exportfile[0])
+                    exporter.begin(keychain_sha256=fingerprint, **provenance)
+                export_writer = open_export(args.export_archive and args.export_archive[0])
+                replay_results(writer, export_writer, *decode_results(cached), exporter=exporter)
+                writer.close()
+                export_writer.close()
+                if exporter is not None:
+                    exporter.close()
+                result_cache.close()
+                exit()
+
     keychain = KeyChain(args.file[0])
+    if _stats is not None:
+        for method in ('generateMasterKey', 'findWrappingKey', 'KeyblobDecryption', 'getRecord', 'SSGPDecryption',
+                       'PrivateKeyDecryption'):
+            _stats.instrument(keychain, method)
 
     if keychain.open() is False:
         print '[!] ERROR: %s Open Failed' % args.file[0]
@@ -774,260 +1957,217 @@ def main():
         parser.print_help()
         exit()
 
-    SchemaInfo, TableList = keychain.getSchemaInfo(KeychainHeader.SchemaOffset)
+    try:
+        keychain.getTableDirectory()
+    except ValueError as e:
+        print '[!] ERROR: Corrupted Keychain: %s' % e
+        exit()
 
-    TableMetadata, RecordList = keychain.getTable(TableList[0])
+    if args.identities:
+        writer = make_writer(args.format, output, args.secret_encoding, columns=IdentityRecord._fields)
+        for certificate, public_key, private_key in keychain.iter_identities(**filters):
+            writer.write_record(IDENTITY_TABLE, IdentityRecord(certificate.PrintName, private_key.PrintName,
+                                                               str(certificate.PublicKeyHash)))
+        writer.close()
+        exit()
 
-    tableCount, tableEnum = keychain.getTablenametoList(RecordList, TableList)
+    if args.triage:
+        writer = make_writer(args.format, output, args.secret_encoding, columns=TRIAGE_COLUMNS)
+        counts = {}
+        for table, record in triage(keychain, tables, filters):
+            writer.write_record(table, record)
+            counts[table] = counts.get(table, 0) + 1
+        writer.status('[+] Triage: %s' % ', '.join('%d %s' % (counts.get(TABLE_NAMES[name], 0), name)
+                                                     for name in sorted(args.tables or TABLE_NAMES)))
+        writer.close()
+        exit()
 
-    # generate database key
-    if args.password is not None:
-        masterkey = keychain.generateMasterKey(args.password[0], TableList[tableEnum[CSSM_DL_DB_RECORD_METADATA]])
-        dbkey = keychain.findWrappingKey(masterkey, TableList[tableEnum[CSSM_DL_DB_RECORD_METADATA]])
+    if args.key_cache is not None:
+        from cache import KeyCache
 
-    elif args.key is not None:
-        dbkey = keychain.findWrappingKey(unhexlify(args.key[0]), TableList[tableEnum[CSSM_DL_DB_RECORD_METADATA]])
+        keychain.key_cache = KeyCache(args.key_cache[0], args.key_cache_ttl)
 
-    elif args.unlockfile is not None:
-        with open(args.unlockfile[0], mode='rb') as uf:
-            filecontent = uf.read()
-        unlockkeyblob = _memcpy(filecontent, _UNLOCK_BLOB)
-        dbkey = keychain.findWrappingKey(unlockkeyblob.masterKey, TableList[tableEnum[CSSM_DL_DB_RECORD_METADATA]])
+    if args.password is not None:
+        unlocked = keychain.unlock(password=args.password[0])
+    elif args.key is not None:
+        unlocked = keychain.unlock(masterkey=args.key[0])
     else:
-        print '[!] ERROR: password or master key candidate is invalid'
-        exit()
+        unlocked = keychain.unlock(unlockfile=args.unlockfile[0])
+
+    if keychain.key_cache is not None:
+        keychain.key_cache.close()
+        if _stats is not None:
+            _stats.count('key cache hits', keychain.key_cache.hits)
 
-    if len(dbkey) == 0:
+    if not unlocked:
         print '[!] ERROR: password or master key candidate is invalid'
         exit()
 
-    # DEBUG
-    print ' [-] DB Key'
-    # hexdump(dbkey)
+    if args.cache is not None:
+        from cache import PlaintextCache
 
-    key_list = {}  # keyblob list
+        keychain.plaintext_cache = PlaintextCache(args.cache[0], args.cache_size * 1024 * 1024)
 
-    # get symmetric key blob
-    print '[+] Symmetric Key Table:'
-    # print '0x%.8x' % (
-    #             sizeof(_APPL_DB_HEADER) + TableList[tableEnum[CSSM_DL_DB_RECORD_SYMMETRIC_KEY]])
-    TableMetadata, symmetrickey_list = keychain.getTable(TableList[tableEnum[CSSM_DL_DB_RECORD_SYMMETRIC_KEY]])
-
-    for symmetrickey_record in symmetrickey_list:
-        keyblob, ciphertext, iv, return_value = keychain.getKeyblobRecord(
-            TableList[tableEnum[CSSM_DL_DB_RECORD_SYMMETRIC_KEY]],
-            symmetrickey_record)
-        if return_value == 0:
-            passwd = keychain.KeyblobDecryption(ciphertext, iv, dbkey)
-            if passwd != '':
-                key_list[keyblob] = passwd
+    # forked once for every table, before the export and stage threads start
+    pool = keychain.openPool(args.jobs) if args.jobs > 1 else None
 
-    try:
-        TableMetadata, genericpw_list = keychain.getTable(TableList[tableEnum[CSSM_DL_DB_RECORD_GENERIC_PASSWORD]])
+    sidecar = None
+    if args.incremental is not None:
+        from cache import SidecarIndex
 
-        for genericpw in genericpw_list:
-            record = keychain.getGenericPWRecord(TableList[tableEnum[CSSM_DL_DB_RECORD_GENERIC_PASSWORD]], genericpw)
-            print '[+] Generic Password Record'
-            try:
-                real_key = key_list[record[0][0:20]]
-                passwd = keychain.SSGPDecryption(record[0], real_key)
-            except KeyError:
-                passwd = ''
-            print ' [-] Create DateTime: %s' % record[1]  # 16byte string
-            print ' [-] Last Modified DateTime: %s' % record[2]  # 16byte string
-            print ' [-] Description : %s' % record[3]
-            print ' [-] Creator : %s' % record[4]
-            print ' [-] Type : %s' % record[5]
-            print ' [-] PrintName : %s' % record[6]
-            print ' [-] Alias : %s' % record[7]
-            print ' [-] Account : %s' % record[8]
-            print ' [-] Service : %s' % record[9]
-            print ' [-] Password'
-            hexdump(passwd)
-            print ''
-
-    except KeyError:
-        print '[!] Generic Password Table is not available'
-        pass
+        sidecar = SidecarIndex(args.incremental or args.file[0] + '.cbindex')
 
-    try:
-        TableMetadata, internetpw_list = keychain.getTable(TableList[tableEnum[CSSM_DL_DB_RECORD_INTERNET_PASSWORD]])
+    writer = make_writer(args.format, output, args.secret_encoding)
 
-        for internetpw in internetpw_list:
-            record = keychain.getInternetPWRecord(TableList[tableEnum[CSSM_DL_DB_RECORD_INTERNET_PASSWORD]], internetpw)
-            print '[+] Internet Record'
-            try:
-                real_key = key_list[record[0][0:20]]
-                passwd = keychain.SSGPDecryption(record[0], real_key)
-            except KeyError:
-                passwd = ''
-            print ' [-] Create DateTime: %s' % record[1]  # 16byte string
-            print ' [-] Last Modified DateTime: %s' % record[2]  # 16byte string
-            print ' [-] Description : %s' % record[3]
-            print ' [-] Comment : %s' % record[4]
-            print ' [-] Creator : %s' % record[5]
-            print ' [-] Type : %s' % record[6]
-            print ' [-] PrintName : %s' % record[7]
-            print ' [-] Alias : %s' % record[8]
-            print ' [-] Protected : %s' % record[9]
-            print ' [-] Account : %s' % record[10]
-            print ' [-] SecurityDomain : %s' % record[11]
-            print ' [-] Server : %s' % record[12]
-            try:
-                print ' [-] Protocol Type : %s' % PROTOCOL_TYPE[record[13]]
-            except KeyError:
-                print ' [-] Protocol Type : %s' % record[13]
-            try:
-                print ' [-] Auth Type : %s' % AUTH_TYPE[record[14]]
-            except KeyError:
-                print ' [-] Auth Type : %s' % record[14]
-            print ' [-] Port : %d' % record[15]
-            print ' [-] Path : %s' % record[16]
-            print ' [-] Password'
-            hexdump(passwd)
-            print ''
+    exporter = None
+    if args.exportfile is not None:
+        exporter = StageExporter(args.exportfile[0], keychain_sha256=hashlib.sha256(keychain.fbuf).hexdigest(),
+                                 **provenance)
 
-    except KeyError:
-        print '[!] Internet Password Table is not available'
-        pass
-
-    try:
-        TableMetadata, applesharepw_list = keychain.getTable(
-            TableList[tableEnum[CSSM_DL_DB_RECORD_APPLESHARE_PASSWORD]])
-
-        for applesharepw in applesharepw_list:
-            record = keychain.getAppleshareRecord(TableList[tableEnum[CSSM_DL_DB_RECORD_APPLESHARE_PASSWORD]],
-                                                  applesharepw)
-            print '[+] AppleShare Record (no more used OS X)'
-            try:
-                real_key = key_list[record[0][0:20]]
-                passwd = keychain.SSGPDecryption(record[0], real_key)
-            except KeyError:
-                passwd = ''
-            # print ''
-            # print ' [-] Create DateTime: %s' % record[1]  # 16byte string
-            # print ' [-] Last Modified DateTime: %s' % record[2]  # 16byte string
-            # print ' [-] Description : %s' % record[3]
-            # print ' [-] Comment : %s' % record[4]
-            # print ' [-] Creator : %s' % record[5]
-            # print ' [-] Type : %s' % record[6]
-            # print ' [-] PrintName : %s' % record[7]
-            # print ' [-] Alias : %s' % record[8]
-            # print ' [-] Protected : %s' % record[9]
-            # print ' [-] Account : %s' % record[10]
-            # print ' [-] Volume : %s' % record[11]
-            # print ' [-] Server : %s' % record[12]
-            # try:
-                # print ' [-] Protocol Type : %s' % PROTOCOL_TYPE[record[13]]
-            # except KeyError:
-            #     print ' [-] Protocol Type : %s' % record[13]
-            # print ' [-] Address : %d' % record[14]
-            # print ' [-] Signature : %s' % record[15]
-            # print ' [-] Password'
-            # hexdump(passwd)
-            # print ''
-
-    except KeyError:
-        print '[!] AppleShare Table is not available'
-        pass
-
-    try:
-        TableMetadata, x509CertList = keychain.getTable(TableList[tableEnum[CSSM_DL_DB_RECORD_X509_CERTIFICATE]])
-
-        for i, x509Cert in enumerate(x509CertList, 1):
-            record = keychain.getx509Record(TableList[tableEnum[CSSM_DL_DB_RECORD_X509_CERTIFICATE]], x509Cert)
-            print '[+] Certificate'
-            # print ' [-] Cert Type: %s' % CERT_TYPE[record[0]]
-            # print ' [-] Cert Encoding: %s' % CERT_ENCODING[record[1]]
-            # print ' [-] PrintName : %s' % record[2]
-            # print ' [-] Alias : %s' % record[3]
-            # print ' [-] Subject'
-            # hexdump(record[4])
-            # print ' [-] Issuer :'
-            # hexdump(record[5])
-            # print ' [-] SerialNumber'
-            # hexdump(record[6])
-            # print ' [-] SubjectKeyIdentifier'
-            # hexdump(record[7])
-            # print ' [-] Public Key Hash'
-            # hexdump(record[8])
-            # print ' [-] Certificate'
-            add_file(directory='certs', filename=str(i), cert=str(record[9]))
-            # hexdump(record[9])
-            # print ''
-
-    except KeyError:
-        print '[!] Certification Table is not available'
-        pass
-
-    try:
-        TableMetadata, PublicKeyList = keychain.getTable(TableList[tableEnum[CSSM_DL_DB_RECORD_PUBLIC_KEY]])
-        for PublicKey in PublicKeyList:
-            record = keychain.getKeyRecord(TableList[tableEnum[CSSM_DL_DB_RECORD_PUBLIC_KEY]], PublicKey)
-            print '[+] Public Key Record'
-            # print ' [-] PrintName: %s' % record[0]
-            # print ' [-] Label'
-            # hexdump(record[1])
-            # print ' [-] Key Class : %s' % KEY_TYPE[record[2]]
-            # print ' [-] Private : %d' % record[3]
-            # print ' [-] Key Type : %s' % CSSM_ALGORITHMS[record[4]]
-            # print ' [-] Key Size : %d bits' % record[5]
-            # print ' [-] Effective Key Size : %d bits' % record[6]
-            # print ' [-] Extracted : %d' % record[7]
-            # print ' [-] CSSM Type : %s' % STD_APPLE_ADDIN_MODULE[record[8]]
-            # print ' [-] Public Key'
-            # hexdump(record[10])
-            # print ''
-
-    except KeyError:
-        print '[!] Public Key Table is not available'
-        pass
+    # DEBUG
+    writer.status(' [-] DB Key')
+    # hexdump(keychain.dbkey)
 
-    try:
-        table_meta, PrivateKeyList = keychain.getTable(TableList[tableEnum[CSSM_DL_DB_RECORD_PRIVATE_KEY]])
-        for i, PrivateKey in enumerate(PrivateKeyList, 1):
-            record = keychain.getKeyRecord(TableList[tableEnum[CSSM_DL_DB_RECORD_PRIVATE_KEY]], PrivateKey)
-            print '[+] Private Key Record'
-            # print ' [-] PrintName: %s' % record[0]
-            # print ' [-] Label'
-            # hexdump(record[1])
-            # print ' [-] Key Class : %s' % KEY_TYPE[record[2]]
-            # print ' [-] Private : %d' % record[3]
-            # print ' [-] Key Type : %s' % CSSM_ALGORITHMS[record[4]]
-            # print ' [-] Key Size : %d bits' % record[5]
-            # print ' [-] Effective Key Size : %d bits' % record[6]
-            # print ' [-] Extracted : %d' % record[7]
-            # print ' [-] CSSM Type : %s' % STD_APPLE_ADDIN_MODULE[record[8]]
-            keyname, privatekey = keychain.PrivateKeyDecryption(record[10], record[9], dbkey)
-            # print ' [-] Key Name'
-            # hexdump(keyname)
-            # print ' [-] Decrypted Private Key'
-            add_file(directory='keys', filename=str(i), key=str(privatekey))
-            # hexdump(privatekey)
-            # print ''
-
-    except KeyError:
-        print '[!] Private Key Table is not available'
-        pass
-
-    v = Validator()
-
-    certs = os.listdir(BASEPATH + '/certs')
-    keys = os.listdir(BASEPATH + '/keys')
-
-    k_path = BASEPATH + '/keys/{}'
-    c_path = BASEPATH + '/certs/{}'
-
-    for i, c in enumerate(certs, 1):
-        for j, k in enumerate(keys, 1):
-            if v.validate_by_filenames(key_path=k_path.format(k), cert_path=c_path.format(c)):
-                try:
-                    new_folder_name = len(os.listdir(BASEPATH + 'associated')) + 1
-                except OSError:
-                    new_folder_name = 1
-                add_file('associated/{}'.format(new_folder_name), filename=str(i), cert=open(c_path.format(c)).read())
-                add_file('associated/{}'.format(new_folder_name), filename=str(j), key=open(k_path.format(k)).read())
+    # get symmetric key blob
+    writer.status('[+] Symmetric Key Table:')
+
+    table_names = dict((table, name) for name, table in TABLE_NAMES.items())
+
+    # only kept for --result-cache, otherwise records stream through and are gone once written
+    results = []  # (table, record) in output order, record is None if the table is not available
+    exports = []  # add_file arguments, in order
+    keep_results = result_cache is not None
+    export_writer = open_export(args.export_archive and args.export_archive[0])
+    if _stats is not None:
+        _stats.instrument(export_writer, 'add_file')
+        _stats.instrument(export_writer, '_write', 'export write')
+
+    def export(directory, filename='default', key=None, cert=None):
+        export_writer.add_file(directory, filename, key=key, cert=cert)
+        if keep_results:
+            exports.append((directory, filename, key, cert))
+
+    # records are decrypted on this thread, written and exported by the write stage and the certificates and
+    # keys among them prepared for association by the match stage, all at the same time
+    from pipeline import Stage, format_utilization
+
+    def write_result(item):
+        if item[0] == 'status':
+            writer.status(item[1])
+            return
+        if item[0] == 'unavailable':
+            writer.status(TABLE_UNAVAILABLE[item[1]])
+            if keep_results:
+                results.append((item[1], None))
+            return
+
+        kind, table, record, number = item
+        if _stats is not None:
+            _stats.count('records')
+        writer.write_record(table, record)
+        if exporter is not None:
+            exporter.write_record(table, record)
+        if keep_results:
+            results.append((table, record))
+
+        if table == CSSM_DL_DB_RECORD_X509_CERTIFICATE:
+            export(directory='certs', filename=str(number), cert=str(record.Certificate))
+            match_stage.put(('certs', str(number), str(record.Certificate), _publickeyhash(record)))
+        elif table == CSSM_DL_DB_RECORD_PRIVATE_KEY:
+            export(directory='keys', filename=str(number), key=str(record.PrivateKey))
+            match_stage.put(('keys', str(number), str(record.PrivateKey), _publickeyhash(record)))
+
+    matcher = IdentityMatcher(args.verify_identities)
+    if _stats is not None:
+        _stats.instrument(matcher, 'add', 'match')
+        _stats.instrument(matcher, 'finish', 'associate')
+    match_stage = Stage('match', matcher.add, matcher.finish)
+    write_stage = Stage('write', write_result, exporter and exporter.close)
+    started = time.time()
+
+    for table in TABLE_ORDER:
+        if table not in tables:
+            continue
+
+        if table in SSGP_TABLES or table == CSSM_DL_DB_RECORD_PRIVATE_KEY:
+            table_jobs = args.jobs
+        else:
+            table_jobs = 1
 
+        table_started = time.time(), time.clock()
+        try:
+            record_offsets = None
+            if sidecar is not None:
+                signatures, record_offsets, added, deleted = keychain.diffTable(table, sidecar.getTable(table))
+                write_stage.put(('status', '[+] %s table: %d added, %d modified, %d deleted, %d unchanged' % (
+                    table_names[table], added, len(record_offsets) - added, len(deleted),
+                    len(signatures) - len(record_offsets))))
+                for record_number in deleted:
+                    write_stage.put(('status', ' [-] Deleted Record: %d' % record_number))
+
+            processed = set()
+            records = keychain.iter_decrypted(table, table_jobs, record_offsets, pool, **filters)
+            for i, record in enumerate(records, 1):
+                # exports of an incremental run are named by RecordNumber, so earlier runs are not overwritten
+                if sidecar is not None:
+                    i = record.RecordNumber
+                    processed.add(record.RecordNumber)
+                write_stage.put(('record', table, record, i))
+
+            if sidecar is not None:
+                # records the filters skipped keep their old signature (or none), so a later run outputs them
+                sidecar.updateTable(table, signatures, processed)
+
+        except KeyError:
+            write_stage.put(('unavailable', table))
+
+        if _stats is not None:
+            _stats.add_time('table %s' % table_names[table], time.time() - table_started[0],
+                            time.clock() - table_started[1])
+
+    decrypted = time.time()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    write_stage.close()
+
+    if sidecar is not None:
+        sidecar.save()
+
+    key_stats = keychain.key_resolver.getStats()
+    write_key_stats(writer, key_stats)
+
+    if keychain.plaintext_cache is not None:
+        keychain.plaintext_cache.close()
+        cache_stats = keychain.plaintext_cache.getStats()
+        writer.status('[+] Plaintext Cache: %d hits, %d misses, %d evicted' % (
+            cache_stats['hits'], cache_stats['misses'], cache_stats['evictions']))
+        if _stats is not None:
+            _stats.count('plaintext cache hits', cache_stats['hits'])
+            _stats.count('plaintext cache misses', cache_stats['misses'])
+
+    match_stage.close()
+
+    cert_data = dict((name, cert) for name, cert, publickeyhash in matcher.certs)
+    key_data = dict((name, key) for name, key, publickeyhash in matcher.keys)
+
+    for c_name, k_name in matcher.pairs:
+        folder = export_writer.nextFolder('associated')
+        export(folder, filename=c_name, cert=cert_data[c_name])
+        export(folder, filename=k_name, key=key_data[k_name])
+
+    writer.status(format_utilization([('decrypt', decrypted - started - write_stage.waited),
+                                      ('write', write_stage.busy), ('match', match_stage.busy)],
+                                     time.time() - started))
+    writer.close()
+    export_writer.close()
+    if _stats is not None:
+        _stats.count('report bytes written', writer.written)
+        _stats.count('export bytes written', export_writer.written)
+
+    if result_cache is not None:
+        result_cache.put(fingerprint, unlock_material, options, encode_results(results, exports, key_stats))
+        result_cache.close()
 
     exit()
 
@@ -0,0 +1,154 @@
+# Export of certificates and private keys.
+#
+# DirectoryExport writes every file below a base directory (./exported/ by default), ArchiveExport streams
+# them into a single tar or zip file. Both hand the files to a worker thread through a bounded queue, so
+# decryption goes on while earlier files are written, and keep the directories they created and the numbers
+# of the association folders in memory instead of asking the filesystem for every file.
+
+import os
+import tarfile
+import threading
+import time
+import zipfile
+from Queue import Queue, Full
+from cStringIO import StringIO
+
+ARCHIVE_TYPES = ('.tar', '.tar.gz', '.tgz', '.zip')
+
+
+class ExportWriter:
+    QUEUE_SIZE = 256
+
+    def __init__(self):
+        self.folders = {}  # directory -> last numbered subfolder handed out
+        self.count = 0
+        self.written = 0  # bytes
+        self.error = None
+        self.finished = False  # the worker saw the end of the queue
+        self.queue = Queue(self.QUEUE_SIZE)
+        self.worker = threading.Thread(target=self._run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.finished = True
+                break
+            if self.error is not None:
+                continue  # drain the queue, the error is raised by add_file() and close()
+            try:
+                self._write(*item)
+                self.written += len(item[1])
+            except Exception as e:
+                self.error = e
+
+    def _write(self, path, data):
+        raise NotImplementedError
+
+    def _existing(self, directory):
+        return 0
+
+    ## queue an item for the worker, without blocking forever on a full queue if the worker is gone
+    def _put(self, item):
+        while True:
+            if self.error is not None:
+                raise self.error
+            if not self.worker.is_alive():
+                raise IOError('export writer thread stopped')
+            try:
+                self.queue.put(item, timeout=0.5)
+                return
+            except Full:
+                pass
+
+    def add_file(self, directory, filename='default', key=None, cert=None):
+        if key is not None:
+            self._put(('%s/%s.key' % (directory, filename), key))
+            self.count += 1
+        if cert is not None:
+            self._put(('%s/%s.crt' % (directory, filename), cert))
+            self.count += 1
+
+    ## next free numbered subfolder of a directory, e.g. associated/3
+    def nextFolder(self, directory):
+        if directory not in self.folders:
+            self.folders[directory] = self._existing(directory)
+        self.folders[directory] += 1
+        return '%s/%d' % (directory, self.folders[directory])
+
+    def close(self):
+        """Wait until every file is written, raises the first write error"""
+        while self.worker.is_alive():
+            try:
+                self.queue.put(None, timeout=0.5)
+                break
+            except Full:
+                pass
+        self.worker.join()
+        if self.error is not None:
+            raise self.error
+        if not self.finished:
+            raise IOError('export writer thread stopped')
+        return self.count
+
+
+class DirectoryExport(ExportWriter):
+    def __init__(self, basepath):
+        self.basepath = basepath
+        self.created = set()  # directories known to exist
+        ExportWriter.__init__(self)
+
+    def _write(self, path, data):
+        directory, name = os.path.split(os.path.join(self.basepath, path))
+        if directory not in self.created:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.created.add(directory)
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(data)
+
+    ## numbered subfolders left by earlier runs, counted once
+    def _existing(self, directory):
+        try:
+            return len(os.listdir(os.path.join(self.basepath, directory)))
+        except OSError:
+            return 0
+
+
+class ArchiveExport(ExportWriter):
+    """Streams the files into a .tar, .tar.gz/.tgz or .zip archive"""
+
+    def __init__(self, path):
+        if path.endswith('.zip'):
+            self.archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+            self.tar = False
+        elif path.endswith('.tar.gz') or path.endswith('.tgz'):
+            self.archive = tarfile.open(path, 'w:gz')
+            self.tar = True
+        elif path.endswith('.tar'):
+            self.archive = tarfile.open(path, 'w')
+            self.tar = True
+        else:
+            raise ValueError('unsupported archive type (use %s): %s' % (', '.join(ARCHIVE_TYPES), path))
+        ExportWriter.__init__(self)
+
+    def _write(self, path, data):
+        if self.tar:
+            info = tarfile.TarInfo(path)
+            info.size = len(data)
+            info.mtime = time.time()
+            info.mode = 0600
+            self.archive.addfile(info, StringIO(data))
+        else:
+            info = zipfile.ZipInfo(path, time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0600 << 16
+            self.archive.writestr(info, data)
+
+    def close(self):
+        try:
+            return ExportWriter.close(self)
+        finally:
+            self.archive.close()
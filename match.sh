@@ -1,13 +1,19 @@
 #!/bin/bash
 
+# public key of every exported private key, computed once
+declare -A pubkeys
+for k in exported/keys/* ; do
+	pubkeys[$k]=$(openssl pkey -pubout -inform DER -in $k -outform PEM)
+done
+
 for c in exported/certs/* ; do
 	echo "=================================="
 	echo "Certificate: $c"
 	openssl x509 -noout -text -inform DER -in $c | grep Subject:
+	pub=$(openssl x509 -pubkey -inform DER -in $c -noout)
 	for k in exported/keys/* ; do
-		if cmp --quiet <(openssl x509 -pubkey -inform DER -in $c -noout) <(openssl pkey -pubout -inform DER -in $k -outform PEM) ; then
+		if [ "$pub" == "${pubkeys[$k]}" ] ; then
 			echo "Key: $k"
 		fi
 	done
 done
-
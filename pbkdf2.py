@@ -34,11 +34,11 @@ def xorstr(a, b):
     if len(a) != len(b):
         raise "xorstr(): lengths differ"
 
-    ret = ''
-    for i in range(len(a)):
-        ret += chr(ord(a[i]) ^ ord(b[i]))
+    if not a:
+        return ''
 
-    return ret
+    # xor the whole strings as two big integers instead of byte by byte
+    return unhexlify('%0*x' % (len(a) * 2, int(hexlify(a), 16) ^ int(hexlify(b), 16)))
 
 
 def prf(h, data):
@@ -51,13 +51,14 @@ def prf(h, data):
 # password, it will be copy()ed and not modified.
 def pbkdf2_F(h, salt, itercount, blocknum):
     U = prf(h, salt + pack('>i', blocknum))
-    T = U
+    # accumulate the xor of all U as an integer, converted back to a string once at the end
+    T = int(hexlify(U), 16)
 
     for i in range(2, itercount + 1):
         U = prf(h, U)
-        T = xorstr(T, U)
+        T ^= int(hexlify(U), 16)
 
-    return T
+    return unhexlify('%0*x' % (len(U) * 2, T))
 
 
 def test():
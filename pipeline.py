@@ -0,0 +1,74 @@
+# Staged execution of a keychain run.
+#
+# main() parses and decrypts the records on its own thread (and the worker pool with -j) while Stage threads
+# consume the results as they arrive: one writes the report, the SQLite export and the exported files in record
+# order, another prepares the certificate/private key association. Stages are joined by bounded queues, so a
+# slow stage holds back the one feeding it instead of buffering the whole keychain, and every stage keeps the
+# time it was busy and the time its producer waited for room in its queue.
+
+import threading
+import time
+from Queue import Queue
+
+
+class Stage:
+    QUEUE_SIZE = 256
+
+    def __init__(self, name, handler, finish=None):
+        """handler(item) is called on the stage thread for every item put, finish() once after the last one"""
+        self.name = name
+        self.handler = handler
+        self.finish = finish
+        self.count = 0
+        self.busy = 0.0  # seconds spent in handler and finish
+        self.waited = 0.0  # seconds producers were blocked on a full queue
+        self.error = None
+        self.queue = Queue(self.QUEUE_SIZE)
+        self.worker = threading.Thread(target=self._run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue  # drain the queue, the error is raised by put() and close()
+            self._call(self.handler, item)
+            self.count += 1
+
+        if self.finish is not None and self.error is None:
+            self._call(self.finish)
+
+    def _call(self, func, *args):
+        start = time.time()
+        try:
+            func(*args)
+        except Exception as e:
+            self.error = e
+        self.busy += time.time() - start
+
+    def put(self, item):
+        if self.error is not None:
+            raise self.error
+        start = time.time()
+        self.queue.put(item)
+        self.waited += time.time() - start
+
+    def close(self):
+        """Wait until every item is handled and finish() returned, raises the first error of the stage"""
+        self.queue.put(None)
+        self.worker.join()
+        if self.error is not None:
+            raise self.error
+
+    def getStats(self):
+        return {'items': self.count, 'busy': self.busy, 'waited': self.waited}
+
+
+## one status line on how busy the stages of a run were, as (name, busy seconds) over elapsed seconds
+def format_utilization(stages, elapsed):
+    elapsed = max(elapsed, 1e-6)
+    return '[+] Stages: %s (%.2fs)' % (', '.join('%s %d%% busy' % (name, min(100, round(busy * 100 / elapsed)))
+                                                  for name, busy in stages), elapsed)
@@ -49,6 +49,9 @@ Note: This code was not written for high-end systems needing a fast
 """
 
 
+from binascii import hexlify, unhexlify
+from operator import xor
+
 # Modes of crypting / cyphering
 ECB = 0
 CBC = 1
@@ -240,39 +243,21 @@ class des:
 
     def __String_to_BitList(self, data):
         """Turn the string data, into a list of bits (1, 0)'s"""
-        l = len(data) * 8
-        result = [0] * l
-        pos = 0
-        for c in data:
-            i = 7
-            ch = ord(c)
-            while i >= 0:
-                if ch & (1 << i) != 0:
-                    result[pos] = 1
-                else:
-                    result[pos] = 0
-                pos += 1
-                i -= 1
+        if not data:
+            return []
 
-        return result
+        return map(int, bin(int(hexlify(data), 16))[2:].zfill(len(data) * 8))
 
     def __BitList_to_String(self, data):
         """Turn the list of bits -> data, into a string"""
-        result = ''
-        pos = 0
-        c = 0
-        while pos < len(data):
-            c += data[pos] << (7 - (pos % 8))
-            if (pos % 8) == 7:
-                result += chr(c)
-                c = 0
-            pos += 1
-
-        return result
+        if not data:
+            return ''
+
+        return unhexlify('%0*x' % (len(data) / 4, int(''.join(map(str, data)), 2)))
 
     def __permutate(self, table, block):
         """Permutate this block with the specified table"""
-        return map(lambda x: block[x], table)
+        return map(block.__getitem__, table)
 
     # Transform the secret key, so that it is ready for data processing
     # Create the 16 subkeys, K[1] - K[16]
@@ -325,7 +310,7 @@ class des:
             self.R = self.__permutate(des.__expansion_table, self.R)
 
             # Exclusive or R[i - 1] with K[i], create B[1] to B[8] whilst here
-            self.R = map(lambda x, y: x ^ y, self.R, self.Kn[iteration])
+            self.R = map(xor, self.R, self.Kn[iteration])
             B = [self.R[:6], self.R[6:12], self.R[12:18], self.R[18:24], self.R[24:30], self.R[30:36], self.R[36:42],
                  self.R[42:]]
             # Optimization: Replaced below commented code with above
@@ -362,7 +347,7 @@ class des:
             self.R = self.__permutate(des.__p, Bn)
 
             # Xor with L[i - 1]
-            self.R = map(lambda x, y: x ^ y, self.R, self.L)
+            self.R = map(xor, self.R, self.L)
             # Optimization: This now replaces the below commented code
             #j = 0
             #while j < len(self.R):
@@ -425,7 +410,7 @@ class des:
             # Xor with IV if using CBC mode
             if self.getMode() == CBC:
                 if crypt_type == des.ENCRYPT:
-                    block = map(lambda x, y: x ^ y, block, iv)
+                    block = map(xor, block, iv)
                 #j = 0
                 #while j < len(block):
                 #	block[j] = block[j] ^ iv[j]
@@ -434,7 +419,7 @@ class des:
                 processed_block = self.__des_crypt(block, crypt_type)
 
                 if crypt_type == des.DECRYPT:
-                    processed_block = map(lambda x, y: x ^ y, processed_block, iv)
+                    processed_block = map(xor, processed_block, iv)
                     #j = 0
                     #while j < len(processed_block):
                     #	processed_block[j] = processed_block[j] ^ iv[j]
@@ -567,11 +552,11 @@ class triple_des:
         if len(x) != len(y):
             raise "string lengths differ %d %d" % (len(x), len(y))
 
-        ret = ''
-        for i in range(len(x)):
-            ret += chr(ord(x[i]) ^ ord(y[i]))
+        if not x:
+            return ''
 
-        return ret
+        # xor the whole strings as two big integers instead of byte by byte
+        return unhexlify('%0*x' % (len(x) * 2, int(hexlify(x), 16) ^ int(hexlify(y), 16)))
 
     def encrypt(self, data, pad=''):
         """encrypt(data, [pad]) -> string
@@ -633,17 +618,12 @@ class triple_des:
             if len(data) % self.block_size != 0:
                 raise "Can only decrypt multiples of blocksize"
 
-            lastblock = self.getIV()
-            retdata = ''
-            for i in range(0, len(data), self.block_size):
-                # can I arrange this better? probably...
-                cipherchunk = data[i:i + self.block_size]
-                thisblock = self.__key3.decrypt(cipherchunk)
-                thisblock = self.__key2.encrypt(thisblock)
-                thisblock = self.__key1.decrypt(thisblock)
-                retdata += self.xorstr(lastblock, thisblock)
-                lastblock = cipherchunk
-            return retdata
+            # run the block cipher over all blocks at once, then apply the CBC chaining in one xor:
+            # every plaintext block is the decrypted block xor the previous ciphertext block (the IV for the first)
+            plain = self.__key3.decrypt(data)
+            plain = self.__key2.encrypt(plain)
+            plain = self.__key1.decrypt(plain)
+            return self.xorstr(self.getIV() + data[:-self.block_size], plain)
 
         raise "Not reached"
 
@@ -0,0 +1,243 @@
+# Long running service mode.
+#
+# The service keeps a pool of worker processes forked once at startup (with every module already imported)
+# and accepts jobs over HTTP on localhost or on a Unix socket:
+#
+#   POST /jobs    {"path": "/evidence/login.keychain", "password": "...", "priority": 5}
+#                 or {"keychain": "<base64 keychain data>", "masterkey": "..."}
+#                 optional: "unlockfile", "tables", "service", "account", "server", "label", "timeout",
+#                 "secret_encoding"
+#   GET  /status  queued and finished job counts
+#
+# Jobs wait in a priority queue (higher priority first, then in order of arrival) and the results are streamed back
+# as JSON lines: one object per record, then one object with the "status" of the job. A worker sends the records
+# in chunks while it decrypts them (at least one per table), and every chunk is written to the client as soon as
+# it arrives. A job that fails or times out after some of its records were sent still ends with its status.
+
+import base64
+import functools
+import json
+import os
+import signal
+import socket
+import sys
+import tempfile
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from Queue import PriorityQueue, Queue
+from SocketServer import ThreadingMixIn, UnixStreamServer
+
+from batch import UNLOCK_KINDS, _initworker as _initjobs, _runjob
+
+_chunks = None  # SimpleQueue of (job, kind, value) messages to the service, in a worker
+
+
+def _initworker(chunks):
+    global _chunks
+    _chunks = chunks
+    _initjobs()
+
+
+## run a job on a worker, its process gets emit= to send the records as they are decrypted
+def _streamjob(task, job):
+    process, path, material, timeout = task
+    sent = []
+
+    def emit(records):
+        _chunks.put((job, 'records', records))
+        sent.append(len(records))
+
+    path, status, error, records, seconds = _runjob((functools.partial(process, emit=emit), path, material, timeout))
+    if records:
+        emit(records)
+    _chunks.put((job, 'done', (path, status, error, sum(sent), seconds)))
+
+
+class Service:
+    def __init__(self, pool, chunks, processes, make_process, make_writer, timeout=None):
+        """pool: multiprocessing.Pool of processes workers initialized with _initworker(chunks).
+        make_process(job) returns the batch process function of a job (ValueError for a bad job), which takes
+        an emit= function for the records, and make_writer(stream, job) the JSON lines writer of its results."""
+        self.pool = pool
+        self.chunks = chunks
+        self.processes = processes
+        self.make_process = make_process
+        self.make_writer = make_writer
+        self.timeout = timeout
+        self.queue = PriorityQueue()
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.finished = 0
+        self.streams = {}  # job -> Queue of its messages, while it runs
+
+        collector = threading.Thread(target=self._collect)
+        collector.daemon = True
+        collector.start()
+
+        # one dispatcher per worker, so jobs leave the priority queue only when a worker is free
+        for i in xrange(processes):
+            dispatcher = threading.Thread(target=self._dispatch)
+            dispatcher.daemon = True
+            dispatcher.start()
+
+    ## collector thread: hand the messages of the workers to the streams of their jobs
+    def _collect(self):
+        while True:
+            job, kind, value = self.chunks.get()
+            with self.lock:
+                stream = self.streams.get(job)
+                if kind == 'done':
+                    self.streams.pop(job, None)
+                    self.finished += 1
+            if stream is not None:
+                stream.put((kind, value))
+
+    def _dispatch(self):
+        while True:
+            priority, sequence, task, stream = self.queue.get()
+            with self.lock:
+                self.streams[sequence] = stream
+            try:
+                self.pool.apply(_streamjob, (task, sequence))
+            except Exception as e:
+                # the job never finished on the worker, nothing more is sent for it
+                with self.lock:
+                    self.streams.pop(sequence, None)
+                    self.finished += 1
+                stream.put(('done', (task[1], 'error', '%s: %s' % (type(e).__name__, e), 0, 0.0)))
+
+    def submit(self, job, path, material):
+        """Queue a job, returns a Queue that receives ('records', [(table, record), ...]) while the job runs,
+        then ('done', (path, status, error, record count, seconds))"""
+        task = self.make_process(job), path, material, job.get('timeout', self.timeout)
+        priority = -int(job.get('priority', 0))
+
+        stream = Queue()
+        with self.lock:
+            self.sequence += 1
+            self.queue.put((priority, self.sequence, task, stream))
+        return stream
+
+    def getStats(self):
+        return {'queued': self.queue.qsize(), 'finished': self.finished, 'workers': self.processes}
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        sys.stderr.write('%s - - [%s] %s\n' % (self.address_string(), self.log_date_time_string(), format % args))
+
+    def send_json(self, code, value):
+        body = json.dumps(value) + '\n'
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/status':
+            return self.send_json(404, {'error': 'not found'})
+        self.send_json(200, self.server.service.getStats())
+
+    def do_POST(self):
+        """Run a job and stream its records back while it runs, then its status"""
+        if self.path != '/jobs':
+            return self.send_json(404, {'error': 'not found'})
+
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if not isinstance(job, dict):
+                raise ValueError('a job is a JSON object')
+        except ValueError as e:
+            return self.send_json(400, {'error': 'bad job: %s' % e})
+
+        material = dict((kind, str(job[kind])) for kind in UNLOCK_KINDS if job.get(kind))
+        if len(material) != 1:
+            return self.send_json(400, {'error': 'a job needs exactly one of %s' % ', '.join(UNLOCK_KINDS)})
+
+        upload = None
+        if 'keychain' in job:
+            try:
+                data = base64.b64decode(job['keychain'])
+            except (TypeError, ValueError) as e:
+                return self.send_json(400, {'error': 'bad keychain data: %s' % e})
+            fd, upload = tempfile.mkstemp(prefix='chainbreaker-', suffix='.keychain')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            path = upload
+        elif 'path' in job:
+            path = str(job['path'])
+        else:
+            return self.send_json(400, {'error': 'a job needs a path or keychain data'})
+
+        try:
+            try:
+                stream = self.server.service.submit(job, path, material)
+            except (ValueError, TypeError) as e:
+                return self.send_json(400, {'error': 'bad job: %s' % e})
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.end_headers()
+
+            writer = self.server.service.make_writer(self.wfile, job)
+            kind, value = stream.get()
+            while kind == 'records':
+                for table, record in value:
+                    writer.write_record(table, record)
+                writer.flush()
+                kind, value = stream.get()
+        finally:
+            if upload is not None:
+                os.remove(upload)
+
+        path, status, error, count, seconds = value
+        writer.write(json.dumps({'status': status, 'error': error, 'records': count,
+                                 'seconds': round(seconds, 6)}) + '\n')
+        writer.close()
+
+
+class ServiceHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class UnixServiceHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        UnixStreamServer.server_bind(self)
+        os.chmod(self.server_address, 0600)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def _terminate(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def serve(address, service):
+    """Serve jobs on host:port (localhost only by default) or on a Unix socket path until interrupted"""
+    signal.signal(signal.SIGTERM, _terminate)
+
+    if ':' in address and not address.startswith('/'):
+        host, port = address.rsplit(':', 1)
+        server = ServiceHTTPServer((host or '127.0.0.1', int(port)), ServiceHandler)
+    else:
+        server = UnixServiceHTTPServer(address, ServiceHandler)
+    server.service = service
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if server.address_family == socket.AF_UNIX:
+            os.remove(address)
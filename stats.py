@@ -0,0 +1,67 @@
+# Run statistics for --stats.
+#
+# Timers are attached with instrument(), which wraps a function or the method of one object, so a run that does
+# not ask for statistics runs the plain code. Timers keep calls, wall seconds and CPU seconds (of the whole
+# process, time.clock()); counters are plain numbers. Worker processes send their report() back to be merged.
+
+import json
+import time
+
+
+class Stats:
+    def __init__(self):
+        self.timers = {}  # name -> [calls, wall seconds, cpu seconds]
+        self.counters = {}
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, name, wall, cpu, calls=1):
+        timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+        timer[0] += calls
+        timer[1] += wall
+        timer[2] += cpu
+
+    def timed(self, name, func):
+        """func wrapped with the timer name"""
+        def timed_call(*args, **kwargs):
+            wall, cpu = time.time(), time.clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add_time(name, time.time() - wall, time.clock() - cpu)
+        return timed_call
+
+    ## time every call of obj.attribute (a module function or the method of an instance)
+    def instrument(self, obj, attribute, name=None):
+        setattr(obj, attribute, self.timed(name or attribute, getattr(obj, attribute)))
+
+    ## forget everything, in place so that the instrumented functions keep reporting here
+    def clear(self):
+        self.timers.clear()
+        self.counters.clear()
+
+    def merge(self, report):
+        for name, timer in report['timers'].items():
+            self.add_time(name, timer['wall'], timer['cpu'], timer['calls'])
+        for name, value in report['counters'].items():
+            self.count(name, value)
+
+    def report(self):
+        return {
+            'timers': dict((name, {'calls': calls, 'wall': round(wall, 6), 'cpu': round(cpu, 6)})
+                           for name, (calls, wall, cpu) in self.timers.items()),
+            'counters': dict(self.counters),
+        }
+
+    def format(self, format):
+        if format == 'json':
+            return json.dumps(self.report(), sort_keys=True)
+
+        lines = ['[+] Stats']
+        for name in sorted(self.timers):
+            calls, wall, cpu = self.timers[name]
+            lines.append(' [-] %s: %d calls, %.3fs wall, %.3fs cpu' % (name, calls, wall, cpu))
+        for name in sorted(self.counters):
+            lines.append(' [-] %s: %d' % (name, self.counters[name]))
+        return '\n'.join(lines)
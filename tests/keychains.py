@@ -0,0 +1,127 @@
+# Small synthetic keychains for the tests.
+#
+# make_keychain() builds the smallest file chainbreaker opens and unlocks: a schema, the metadata table with
+# the database blob, the symmetric key table and a generic password table. Every byte is derived from the
+# arguments, so the same record comes out byte identical in two keychains (as diffTable() expects of an
+# unchanged record).
+
+import datetime
+import hashlib
+import struct
+from binascii import unhexlify
+
+from pbkdf2 import pbkdf2
+from pyDes import triple_des, ECB
+
+from Schema import CSSM_DL_DB_RECORD_GENERIC_PASSWORD, CSSM_DL_DB_RECORD_SYMMETRIC_KEY, CSSM_DL_DB_RECORD_METADATA
+
+PASSWORD = 'password'
+MAGIC_CMS_IV = unhexlify('4adda22c79e82105')
+MODIFIED = datetime.datetime(2020, 1, 2, 3, 4, 5)
+
+
+def _bytes(label, size):
+    data = ''
+    while len(data) < size:
+        data += hashlib.sha256(label + str(len(data))).digest()
+    return data[:size]
+
+
+def _pad(data):
+    pad = 8 - len(data) % 8
+    return data + chr(pad) * pad
+
+
+def _cbc_encrypt(key, iv, data):
+    cipher = triple_des(key, ECB)
+    lastblock = iv
+    result = []
+    for i in range(0, len(data), 8):
+        lastblock = cipher.encrypt(''.join(chr(ord(x) ^ ord(y)) for x, y in zip(lastblock, data[i:i + 8])))
+        result.append(lastblock)
+    return ''.join(result)
+
+
+## length prefixed attribute, padded to 4 bytes
+def _lv(value):
+    return struct.pack('>I', len(value)) + value + '\0' * ((4 - len(value) % 4) % 4)
+
+
+## record of fields 4 byte header columns: fields[0] is the record size, header maps columns to values and the
+## attributes (column, data) follow the blob
+def _record(columns, header, blob, attributes):
+    values = [0] * columns
+    for column, value in header.items():
+        values[column] = value
+    body = blob + '\0' * ((4 - len(blob) % 4) % 4)
+    for column, data in attributes:
+        values[column] = columns * 4 + len(body) + 1  # the low bit is set in real keychains
+        body += data
+    values[0] = columns * 4 + len(body)
+    return struct.pack('>%dI' % columns, *values) + body
+
+
+def table(table_id, records, free_slots=0, record_count=None, table_size=None, slot_count=None):
+    """A table of records with free_slots zero slots after their offsets. record_count, table_size and
+    slot_count override the values of the header, e.g. for a corrupted table"""
+    base = 28 + (len(records) + free_slots) * 4
+    offsets = []
+    body = ''
+    for record in records:
+        offsets.append(base + len(body))
+        body += record
+    offsets += [0] * free_slots
+    header = struct.pack('>7I', table_size if table_size is not None else base + len(body), table_id,
+                         record_count if record_count is not None else len(records), 0, 0, 0,
+                         slot_count if slot_count is not None else len(offsets))
+    return header + struct.pack('>%dI' % len(offsets), *offsets) + body
+
+
+def generic_password(number, service, account, secret, dbkey, keys):
+    """A generic password record and its symmetric key record, both encrypted under dbkey"""
+    label = 'ssgp' + _bytes('label %d' % number, 16)
+    key = _bytes('key %d' % number, 24)
+    keyiv = _bytes('key iv %d' % number, 8)
+    wrapped = _cbc_encrypt(dbkey, keyiv, _bytes('key prefix', 4) + key + '\x04' * 4)
+    outer = _cbc_encrypt(dbkey, MAGIC_CMS_IV, _pad(wrapped[::-1]))
+    keyblob = struct.pack('>IIII', 0xFADE0711, 1, 24, 24 + len(outer)) + keyiv + outer + '\0' * 8 + label
+    keys.append(struct.pack('>II', 132 + len(keyblob), number) + '\0' * 0x7C + keyblob)
+
+    iv = _bytes('iv %d %s' % (number, secret), 8)
+    ssgp = label + iv + _cbc_encrypt(key, iv, _pad(secret))
+    date = MODIFIED.strftime('%Y%m%d%H%M%SZ') + '\0'
+    return _record(22, {1: number, 4: len(ssgp)}, ssgp,
+                   [(6, date), (7, date), (8, _lv('')), (10, 'aapl'), (11, 'gpwd'), (13, _lv(service)),
+                    (19, _lv(account)), (20, _lv(service))])
+
+
+def make_keychain(passwords, password=PASSWORD, generic_table=None):
+    """Keychain file data with a generic password record per (RecordNumber, service, account, secret) of
+    passwords. generic_table(records) may build the generic password table instead of table()."""
+    salt = _bytes('salt', 20)
+    dbiv = _bytes('db iv', 8)
+    dbkey = _bytes('db key', 24)
+    encrypted = _cbc_encrypt(pbkdf2(password, salt, 1000, 24), dbiv, _pad(dbkey))
+    dbblob = (struct.pack('>IIII', 0xFADE0101, 1, 92, 92 + len(encrypted)) + _bytes('signature', 16) +
+              struct.pack('>III', 0, 300, 0) + salt + dbiv + '\0' * 20 + encrypted)
+    metadata = struct.pack('>8I', 0x38 + len(dbblob), CSSM_DL_DB_RECORD_METADATA, 1, 0, 0, 0, 0, 0x20)
+    metadata += '\0' * (0x38 - len(metadata)) + dbblob
+
+    keys = []
+    records = [generic_password(number, service, account, secret, dbkey, keys)
+               for number, service, account, secret in passwords]
+    tables = [
+        table(0, ['\0' * 8] * 4),
+        metadata,
+        table(CSSM_DL_DB_RECORD_SYMMETRIC_KEY, keys),
+        (generic_table or table)(CSSM_DL_DB_RECORD_GENERIC_PASSWORD, records),
+    ]
+
+    schema_size = 8 + len(tables) * 4
+    offsets = []
+    body = ''
+    for data in tables:
+        offsets.append(schema_size + len(body))
+        body += data + '\0' * ((4 - len(data) % 4) % 4)
+    return (struct.pack('>4sIIII', 'kych', 0x10000, 20, 20, 0) + struct.pack('>II', schema_size + len(body), len(tables)) +
+            struct.pack('>%dI' % len(tables), *offsets) + body)
@@ -0,0 +1,115 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import batch
+
+
+## batch process functions, module level so the workers can unpickle them
+def process(path, material, data=None):
+    name = os.path.basename(path)
+    if name == 'raises':
+        raise ValueError('bad keychain')
+    if name == 'unpicklable':
+        return 'ok', [threading.Lock()]
+    if name == 'exits':
+        os._exit(1)
+    return 'ok', [(name, material, data)]
+
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='chainbreaker-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_csv(self):
+        manifest = batch.load_manifest(self.write('unlock.csv', 'path,password,masterkey,unlockfile\n'
+                                                                'a/login.keychain,secret,,\n'
+                                                                '/evidence/System.keychain,,,SystemKey\n'))
+        self.assertEqual(manifest, {
+            os.path.join(self.directory, 'a/login.keychain'): {'password': 'secret'},
+            '/evidence/System.keychain': {'unlockfile': os.path.join(self.directory, 'SystemKey')},
+        })
+
+    def test_json_list_and_object(self):
+        expected = {os.path.join(self.directory, 'login.keychain'): {'masterkey': 'ab' * 24}}
+        entries = [{'path': 'login.keychain', 'masterkey': 'ab' * 24}]
+        self.assertEqual(batch.load_manifest(self.write('list.json', json.dumps(entries))), expected)
+        entries = {'login.keychain': {'masterkey': 'ab' * 24}}
+        self.assertEqual(batch.load_manifest(self.write('object.json', json.dumps(entries))), expected)
+
+    def test_discover_by_signature(self):
+        os.makedirs(os.path.join(self.directory, 'b'))
+        self.write('b/renamed.db', 'kych' + '\0' * 16)
+        self.write('a.keychain', 'not a keychain')
+        self.assertEqual(list(batch.discover(self.directory)), [os.path.join(self.directory, 'b/renamed.db')])
+
+
+class ScheduleTest(unittest.TestCase):
+    jobs = [('big', {'password': 'x'}), ('small', {'masterkey': 'y'}), ('medium', {'password': 'z'})]
+
+    def test_without_estimate_jobs_keep_their_order(self):
+        self.assertEqual(batch.schedule(self.jobs), [job + ('keychain',) for job in self.jobs])
+
+    def test_cheapest_first_with_job_class(self):
+        costs = {'big': ('long', 90.0), 'small': ('masterkey', 0.1), 'medium': ('password', 5.0)}
+        scheduled = batch.schedule(self.jobs, lambda path, material: costs[path])
+        self.assertEqual(scheduled, [('small', {'masterkey': 'y'}, 'masterkey'),
+                                     ('medium', {'password': 'z'}, 'password'),
+                                     ('big', {'password': 'x'}, 'long')])
+
+    def test_no_jobs(self):
+        self.assertEqual(batch.schedule([], lambda path, material: ('keychain', 1.0)), [])
+
+
+class RunTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='chainbreaker-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_batch(self, names, **kwargs):
+        jobs = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            with open(path, 'wb') as f:
+                f.write('kych ' + name)
+            jobs.append((path, {'password': name}))
+        return dict((os.path.basename(result[0]), result) for result in batch.run(process, jobs, 2, **kwargs))
+
+    def test_every_job_has_a_result(self):
+        results = self.run_batch(['a', 'b', 'raises', 'unpicklable', 'exits', 'c'], timeout=30)
+        self.assertEqual(sorted(results), ['a', 'b', 'c', 'exits', 'raises', 'unpicklable'])
+
+        path, status, error, records, seconds, job_class, waited = results['a']
+        self.assertEqual((status, error, job_class), ('ok', None, 'keychain'))
+        self.assertEqual(records, [('a', {'password': 'a'}, 'kych a')])
+        self.assertTrue(waited >= 0)
+
+        self.assertEqual(results['raises'][1:3], ('error', 'ValueError: bad keychain'))
+        self.assertEqual(results['unpicklable'][1], 'error')
+        self.assertTrue(results['unpicklable'][2].startswith('MaybeEncodingError'))
+        self.assertEqual(results['exits'][1:3], ('error', 'worker process exited'))
+
+    def test_limited_job_class(self):
+        estimate = lambda path, material: ('long' if path.endswith('x') else 'keychain', len(path))
+        results = self.run_batch(['a', 'x', 'bx', 'b'], estimate=estimate, limits={'long': 1})
+        self.assertEqual(dict((name, result[5]) for name, result in results.items()),
+                         {'a': 'keychain', 'b': 'keychain', 'x': 'long', 'bx': 'long'})
+        self.assertEqual(set(result[1] for result in results.values()), set(['ok']))
+
+
+if __name__ == '__main__':
+    unittest.main()
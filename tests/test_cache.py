@@ -0,0 +1,170 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from cache import PlaintextCache, KeyCache, ResultCache, SidecarIndex
+
+
+class CacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='chainbreaker-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    ## flip a byte of every entry file of a cache directory
+    def tamper(self, directory, exclude=()):
+        for name in os.listdir(directory):
+            if name in exclude:
+                continue
+            with open(os.path.join(directory, name), 'r+b') as f:
+                data = f.read()
+                f.seek(-1, os.SEEK_END)
+                f.write(chr(ord(data[-1]) ^ 1))
+
+
+class PlaintextCacheTest(CacheTestCase):
+    def test_round_trip(self):
+        cache = PlaintextCache(self.path('plain'))
+        cache.put('k' * 24, 'i' * 8, 'ciphertext', 'plaintext')
+        self.assertEqual(cache.get('k' * 24, 'i' * 8, 'ciphertext'), 'plaintext')
+        self.assertEqual(cache.getStats(), {'hits': 1, 'misses': 0, 'evictions': 0})
+
+    def test_entries_are_addressed_by_key_iv_and_data(self):
+        cache = PlaintextCache(self.path('plain'))
+        cache.put('k' * 24, 'i' * 8, 'ciphertext', 'plaintext')
+        self.assertIsNone(cache.get('K' * 24, 'i' * 8, 'ciphertext'))
+        self.assertIsNone(cache.get('k' * 24, 'I' * 8, 'ciphertext'))
+        self.assertIsNone(cache.get('k' * 24, 'i' * 8, 'Ciphertext'))
+        self.assertEqual(cache.misses, 3)
+
+    def test_plaintext_is_not_stored_in_the_clear(self):
+        cache = PlaintextCache(self.path('plain'))
+        cache.put('k' * 24, 'i' * 8, 'ciphertext', 'secret plaintext')
+        for name in os.listdir(self.path('plain')):
+            with open(os.path.join(self.path('plain'), name), 'rb') as f:
+                self.assertNotIn('secret plaintext', f.read())
+
+    def test_tampered_entry_misses(self):
+        cache = PlaintextCache(self.path('plain'))
+        cache.put('k' * 24, 'i' * 8, 'ciphertext', 'plaintext')
+        self.tamper(self.path('plain'))
+        self.assertIsNone(cache.get('k' * 24, 'i' * 8, 'ciphertext'))
+
+    def test_trim_evicts_down_to_max_size(self):
+        cache = PlaintextCache(self.path('plain'), max_size=0)
+        for i in xrange(3):
+            cache.put('k' * 24, 'i' * 8, str(i), 'plaintext')
+        self.assertEqual(cache.close(), 0)
+        self.assertEqual(cache.evictions, 3)
+        self.assertEqual(os.listdir(self.path('plain')), [])
+
+
+class KeyCacheTest(CacheTestCase):
+    def test_round_trip_across_instances(self):
+        KeyCache(self.path('keys')).put('blob', 'password', 'd' * 24)
+        cache = KeyCache(self.path('keys'))
+        self.assertEqual(cache.get('blob', 'password'), 'd' * 24)
+        self.assertIsNone(cache.get('blob', 'other password'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_expired_entry_misses_and_is_removed(self):
+        cache = KeyCache(self.path('keys'), ttl=-1)
+        cache.put('blob', 'password', 'd' * 24)
+        self.assertIsNone(cache.get('blob', 'password'))
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(os.listdir(self.path('keys')), [KeyCache.SECRET_NAME])
+
+    def test_trim_keeps_max_entries(self):
+        cache = KeyCache(self.path('keys'), max_entries=2)
+        for i in xrange(4):
+            cache.put('blob%d' % i, 'password', 'd' * 24)
+        self.assertEqual(cache.close(), 2)
+        self.assertEqual(cache.evictions, 2)
+
+    def test_tampered_entry_misses(self):
+        cache = KeyCache(self.path('keys'))
+        cache.put('blob', 'password', 'd' * 24)
+        self.tamper(self.path('keys'), exclude=(KeyCache.SECRET_NAME,))
+        self.assertIsNone(cache.get('blob', 'password'))
+
+
+class ResultCacheTest(CacheTestCase):
+    def test_round_trip(self):
+        cache = ResultCache(self.path('results'))
+        result = ([(1, ('a', 'b'))], [('certs', '1', None, 'cert')], {'unwrapped': 1})
+        cache.put('fingerprint', ('password', 'secret'), ([1], []), result)
+        self.assertEqual(cache.get('fingerprint', ('password', 'secret'), ([1], [])), result)
+
+    def test_entries_are_addressed_by_file_material_and_options(self):
+        cache = ResultCache(self.path('results'))
+        cache.put('fingerprint', ('password', 'secret'), ([1], [], False), 'result')
+        self.assertIsNone(cache.get('other', ('password', 'secret'), ([1], [], False)))
+        self.assertIsNone(cache.get('fingerprint', ('password', 'wrong'), ([1], [], False)))
+        self.assertIsNone(cache.get('fingerprint', ('password', 'secret'), ([1], [], True)))
+        self.assertEqual(cache.getStats(), {'hits': 0, 'misses': 3, 'evictions': 0})
+
+    def test_entries_need_the_local_secret(self):
+        cache = ResultCache(self.path('results'))
+        cache.put('fingerprint', ('password', 'secret'), (), 'result')
+        self.assertEqual(os.stat(self.path('results/secret')).st_mode & 0777, 0600)
+
+        # the entries copied without the secret can neither be found nor decrypted
+        shutil.copytree(self.path('results'), self.path('copy'))
+        os.remove(self.path('copy/secret'))
+        self.assertIsNone(ResultCache(self.path('copy')).get('fingerprint', ('password', 'secret'), ()))
+
+    def test_clear_and_trim_keep_the_secret(self):
+        cache = ResultCache(self.path('results'), max_entries=0)
+        cache.put('fingerprint', ('password', 'secret'), (), 'result')
+        cache.clear()
+        cache.put('fingerprint', ('password', 'secret'), (), 'result')
+        cache.close()
+        self.assertEqual(os.listdir(self.path('results')), ['secret'])
+
+    def test_fingerprint_is_remembered_until_the_file_changes(self):
+        keychain = self.path('login.keychain')
+        with open(keychain, 'wb') as f:
+            f.write('kych' + '\0' * 100)
+        cache = ResultCache(self.path('results'))
+        fingerprint = cache.fingerprint(keychain)
+        cache.close()
+
+        cache = ResultCache(self.path('results'))
+        self.assertEqual(cache.fingerprint(keychain), fingerprint)
+        self.assertFalse(cache.index_dirty)
+
+        with open(keychain, 'ab') as f:
+            f.write('more')
+        self.assertNotEqual(cache.fingerprint(keychain), fingerprint)
+
+    def test_clear_removes_every_result(self):
+        cache = ResultCache(self.path('results'))
+        cache.put('fingerprint', ('password', 'secret'), (), 'result')
+        cache.clear()
+        self.assertIsNone(cache.get('fingerprint', ('password', 'secret'), ()))
+        self.assertEqual(cache.evictions, 1)
+
+
+class SidecarIndexTest(CacheTestCase):
+    def test_signatures_survive_a_save(self):
+        sidecar = SidecarIndex(self.path('login.keychain.cbindex'))
+        self.assertEqual(sidecar.getTable(1), {})
+        sidecar.setTable(1, {7: [100, '', 'digest']})
+        sidecar.save()
+        self.assertEqual(SidecarIndex(self.path('login.keychain.cbindex')).getTable(1), {7: [100, '', 'digest']})
+
+    def test_update_keeps_the_signatures_of_skipped_records(self):
+        sidecar = SidecarIndex(self.path('login.keychain.cbindex'))
+        sidecar.setTable(1, {1: 'old 1', 2: 'old 2', 3: 'deleted'})
+        sidecar.updateTable(1, {1: 'new 1', 2: 'new 2', 4: 'new 4'}, processed=set([1]))
+        # 2 was skipped and keeps its old signature, 4 was skipped and is still unknown, 3 is gone
+        self.assertEqual(sidecar.getTable(1), {1: 'new 1', 2: 'old 2'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,24 @@
+import unittest
+
+from benchmark import DEFERRED_MODULES, IMPORT_BUDGET, check_import
+
+
+class DeferredImportTest(unittest.TestCase):
+    def test_import_loads_no_deferred_module(self):
+        # a fresh interpreter, so modules loaded by other tests do not count
+        loaded = check_import(runs=1)[1]
+        self.assertEqual(loaded, [], 'importing chainbreaker loaded %s' % ', '.join(loaded))
+
+    def test_import_stays_within_budget(self):
+        # the best of a few fresh interpreters, so one slow start on a busy machine does not fail the test
+        milliseconds, loaded = check_import(runs=3)
+        self.assertLessEqual(milliseconds, IMPORT_BUDGET, 'importing chainbreaker took %.1f ms, the budget is %d ms'
+                             % (milliseconds, IMPORT_BUDGET))
+
+    def test_deferred_modules_cover_the_optional_dependencies(self):
+        for module in ('OpenSSL', 'Crypto', 'hexdump', 'sqlite3', 'multiprocessing'):
+            self.assertIn(module, DEFERRED_MODULES)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import struct
+import unittest
+
+from chainbreaker import KeyChain, BLOB_FIELDS
+from Schema import CSSM_DL_DB_RECORD_GENERIC_PASSWORD
+
+from tests.keychains import PASSWORD, make_keychain, table
+
+PASSWORDS = [(1, 'svc1', 'usr1', 'secret-1'), (2, 'svc2', 'usr2', 'secret-2'), (3, 'svc3', 'usr3', 'secret-3')]
+
+
+def keychain(data):
+    keychain = KeyChain('')
+    keychain.fbuf = data
+    return keychain
+
+
+## a file of just the apple DB header and table, getTable(0) reads the table
+def table_keychain(data):
+    return keychain('\x00' * 20 + data)
+
+
+class GetTableTest(unittest.TestCase):
+    def test_records_in_slot_order(self):
+        TableMetadata, record_list = table_keychain(table(1, ['a' * 8, 'b' * 8], free_slots=2)).getTable(0)
+        self.assertEqual(TableMetadata.RecordCount, 2)
+        self.assertEqual(record_list, [44, 52])
+
+    def test_fewer_valid_offsets_than_records_raises(self):
+        data = table(1, ['a' * 8, 'b' * 8], record_count=3)
+        with self.assertRaises(ValueError) as raised:
+            table_keychain(data).getTable(0)
+        self.assertIn('declares 3 records, but only 2 valid record offsets were found', str(raised.exception))
+
+    def test_unaligned_offsets_are_not_records(self):
+        data = table(1, ['a' * 8, 'b' * 8])
+        data = data[:32] + struct.pack('>I', 37) + data[36:]
+        with self.assertRaises(ValueError):
+            table_keychain(data).getTable(0)
+
+    def test_slots_are_clipped_to_the_table_size(self):
+        ## the slot array claims 100 slots, but the table ends after the first one: the aligned value after it
+        ## belongs to the next table and is not read as a record offset
+        data = table(1, ['a' * 8], record_count=2, table_size=32, slot_count=100)
+        data = data[:32] + struct.pack('>I', 8) + data[36:]
+        with self.assertRaises(ValueError) as raised:
+            table_keychain(data).getTable(0)
+        self.assertIn('only 1 valid record offsets', str(raised.exception))
+
+    def test_slots_are_clipped_to_the_file_length(self):
+        data = table(1, ['a' * 8, 'b' * 8], table_size=0x10000, slot_count=0x4000)
+        TableMetadata, record_list = table_keychain(data).getTable(0)
+        self.assertEqual(record_list, [36, 44])
+
+    def test_missing_slot_count_uses_the_table_size(self):
+        TableMetadata, record_list = table_keychain(table(1, ['a' * 8, 'b' * 8], slot_count=0)).getTable(0)
+        self.assertEqual(record_list, [36, 44])
+
+
+class RecordTest(unittest.TestCase):
+    def setUp(self):
+        self.keychain = keychain(make_keychain(PASSWORDS))
+
+    def test_iter_decrypted(self):
+        self.assertTrue(self.keychain.unlock(password=PASSWORD))
+        records = list(self.keychain.iter_decrypted(CSSM_DL_DB_RECORD_GENERIC_PASSWORD))
+        self.assertEqual([(record.Service, record.Account, record.Password) for record in records],
+                         [(service, account, secret) for number, service, account, secret in PASSWORDS])
+
+    def test_filters_skip_decryption(self):
+        self.assertTrue(self.keychain.unlock(password=PASSWORD))
+        decrypted = []
+        decryptRecord = self.keychain.decryptRecord
+
+        def counting(table, record):
+            decrypted.append(record.Service)
+            return decryptRecord(table, record)
+        self.keychain.decryptRecord = counting
+
+        records = list(self.keychain.iter_decrypted(CSSM_DL_DB_RECORD_GENERIC_PASSWORD, service='svc2'))
+        self.assertEqual([record.Password for record in records], ['secret-2'])
+        self.assertEqual(decrypted, ['svc2'])
+
+    def test_decrypting_a_locked_keychain_raises(self):
+        with self.assertRaises(ValueError):
+            list(self.keychain.iter_decrypted(CSSM_DL_DB_RECORD_GENERIC_PASSWORD))
+
+    def test_iter_attributes_leaves_out_blobs(self):
+        records = list(self.keychain.iter_attributes(CSSM_DL_DB_RECORD_GENERIC_PASSWORD, account='usr3'))
+        self.assertEqual(len(records), 1)
+        self.assertEqual((records[0].Service, records[0].Account), ('svc3', 'usr3'))
+        for field in BLOB_FIELDS:
+            self.assertNotIn(field, records[0]._fields)
+
+
+class DiffTableTest(unittest.TestCase):
+    def signatures(self, passwords):
+        signatures, changed, added, deleted = keychain(make_keychain(passwords)).diffTable(
+            CSSM_DL_DB_RECORD_GENERIC_PASSWORD, {})
+        return signatures
+
+    def test_unchanged_table(self):
+        previous = self.signatures(PASSWORDS)
+        signatures, changed, added, deleted = keychain(make_keychain(PASSWORDS)).diffTable(
+            CSSM_DL_DB_RECORD_GENERIC_PASSWORD, previous)
+        self.assertEqual(signatures, previous)
+        self.assertEqual((changed, added, deleted), ([], 0, []))
+
+    def test_added_modified_and_deleted_records(self):
+        previous = self.signatures(PASSWORDS)
+        current = keychain(make_keychain([PASSWORDS[0], (2, 'svc2', 'usr2', 'changed-2'), (4, 'svc4', 'usr4', 'secret-4')]))
+        signatures, changed, added, deleted = current.diffTable(CSSM_DL_DB_RECORD_GENERIC_PASSWORD, previous)
+
+        self.assertEqual(sorted(signatures), [1, 2, 4])
+        self.assertEqual(signatures[1], previous[1])
+        self.assertNotEqual(signatures[2], previous[2])
+        self.assertEqual([current.getRecord(CSSM_DL_DB_RECORD_GENERIC_PASSWORD, record_offset).Service
+                          for record_offset in changed], ['svc2', 'svc4'])
+        self.assertEqual(added, 1)
+        self.assertEqual(deleted, [3])
+
+        self.assertTrue(current.unlock(password=PASSWORD))
+        records = current.iter_decrypted(CSSM_DL_DB_RECORD_GENERIC_PASSWORD, record_offsets=changed)
+        self.assertEqual([record.Password for record in records], ['changed-2', 'secret-4'])
+
+
+if __name__ == '__main__':
+    unittest.main()
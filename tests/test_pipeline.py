@@ -0,0 +1,73 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from chainbreaker import GenericPasswordRecord, StageExporter, CSSM_DL_DB_RECORD_GENERIC_PASSWORD
+from pipeline import Stage, format_utilization
+from writers import SqliteExporter
+
+
+def generic_record(number):
+    return GenericPasswordRecord(SSGP='', CreationDate='', ModDate='', Description='', Creator='', Type='',
+                                 PrintName='item', Alias='', Account='me', Service='AirPort', RecordNumber=number,
+                                 Password='secret')
+
+
+class StageTest(unittest.TestCase):
+    def test_items_are_handled_in_order_then_finished(self):
+        handled = []
+        stage = Stage('test', handled.append, lambda: handled.append('finished'))
+        for i in xrange(Stage.QUEUE_SIZE * 2):
+            stage.put(i)
+        stage.close()
+        self.assertEqual(handled, range(Stage.QUEUE_SIZE * 2) + ['finished'])
+        self.assertEqual(stage.getStats()['items'], Stage.QUEUE_SIZE * 2)
+
+    def test_handler_errors_are_raised_to_the_producer(self):
+        def fail(item):
+            raise ValueError('bad item %d' % item)
+
+        stage = Stage('test', fail)
+        stage.put(1)
+        with self.assertRaises(ValueError):
+            stage.close()
+
+    def test_utilization(self):
+        self.assertEqual(format_utilization([('decrypt', 1.0), ('write', 0.5)], 2.0),
+                         '[+] Stages: decrypt 50% busy, write 25% busy (2.00s)')
+
+
+class StageExporterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='chainbreaker-test-')
+        self.path = os.path.join(self.directory, 'export.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_more_than_a_batch_through_the_write_stage(self):
+        exporter = StageExporter(self.path, keychain='login.keychain')
+        stage = Stage('write', lambda record: exporter.write_record(CSSM_DL_DB_RECORD_GENERIC_PASSWORD, record),
+                      exporter.close)
+        records = SqliteExporter.BATCH_SIZE + 10
+        for i in xrange(records):
+            stage.put(generic_record(i))
+        stage.close()
+
+        db = sqlite3.connect(self.path)
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM generic').fetchone(), (records,))
+        self.assertEqual(db.execute('SELECT keychain, records FROM runs').fetchall(), [('login.keychain', records)])
+
+    def test_run_without_records(self):
+        exporter = StageExporter(self.path, keychain='login.keychain')
+        stage = Stage('write', None, exporter.close)
+        stage.close()
+
+        db = sqlite3.connect(self.path)
+        self.assertEqual(db.execute('SELECT records FROM runs').fetchall(), [(0,)])
+
+
+if __name__ == '__main__':
+    unittest.main()
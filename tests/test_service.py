@@ -0,0 +1,99 @@
+import functools
+import httplib
+import json
+import multiprocessing
+import threading
+import unittest
+from multiprocessing.queues import SimpleQueue
+
+from service import Service, ServiceHTTPServer, ServiceHandler, _initworker
+
+
+## service process function, module level so the workers can unpickle it: every job sends two chunks of records
+def process(path, material, emit=None, fail=False):
+    emit([('t', 1), ('t', 2)])
+    emit([('t', 3)])
+    if fail:
+        raise ValueError('failed after 3 records')
+    return 'ok', []
+
+
+def make_process(job):
+    if job.get('bad'):
+        raise ValueError('bad option')
+    return functools.partial(process, fail=job.get('fail', False))
+
+
+class LineWriter:
+    def __init__(self, stream, job):
+        self.stream = stream
+
+    def write_record(self, table, record):
+        self.write(json.dumps([table, record]) + '\n')
+
+    def write(self, data):
+        self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        self.flush()
+
+
+class ServiceTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.chunks = SimpleQueue()
+        cls.pool = multiprocessing.Pool(2, _initworker, (cls.chunks,))
+        cls.service = Service(cls.pool, cls.chunks, 2, make_process, LineWriter)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.terminate()
+        cls.pool.join()
+
+    def messages(self, stream):
+        messages = [stream.get(timeout=10)]
+        while messages[-1][0] == 'records':
+            messages.append(stream.get(timeout=10))
+        return messages
+
+    def test_records_are_streamed_in_chunks_then_done(self):
+        messages = self.messages(self.service.submit({}, 'a.keychain', {'password': 'x'}))
+        self.assertEqual(messages[:2], [('records', [('t', 1), ('t', 2)]), ('records', [('t', 3)])])
+        path, status, error, count, seconds = messages[2][1]
+        self.assertEqual((messages[2][0], path, status, error, count), ('done', 'a.keychain', 'ok', None, 3))
+
+    def test_a_failing_job_keeps_the_records_it_sent(self):
+        messages = self.messages(self.service.submit({'fail': True}, 'a.keychain', {'password': 'x'}))
+        self.assertEqual(len(messages), 3)
+        path, status, error, count, seconds = messages[2][1]
+        self.assertEqual((status, error, count), ('error', 'ValueError: failed after 3 records', 3))
+
+    def test_bad_job_is_not_queued(self):
+        with self.assertRaises(ValueError):
+            self.service.submit({'bad': True}, 'a.keychain', {'password': 'x'})
+
+    def test_http_response_streams_records_then_status(self):
+        server = ServiceHTTPServer(('127.0.0.1', 0), ServiceHandler)
+        server.service = self.service
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            connection = httplib.HTTPConnection('127.0.0.1', server.server_address[1], timeout=10)
+            connection.request('POST', '/jobs', json.dumps({'path': 'a.keychain', 'password': 'x'}))
+            response = connection.getresponse()
+            self.assertEqual(response.status, 200)
+            lines = [json.loads(line) for line in response.read().splitlines()]
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        self.assertEqual(lines[:3], [['t', 1], ['t', 2], ['t', 3]])
+        self.assertEqual((lines[3]['status'], lines[3]['records']), ('ok', 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
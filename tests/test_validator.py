@@ -0,0 +1,78 @@
+import unittest
+
+import OpenSSL.crypto as c
+
+from chainbreaker import IdentityMatcher
+from validator import Validator
+
+
+## DER private key and self signed DER certificate of a new RSA key
+def make_identity(name):
+    key = c.PKey()
+    key.generate_key(c.TYPE_RSA, 1024)
+    cert = c.X509()
+    cert.get_subject().CN = name
+    cert.set_issuer(cert.get_subject())
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(3600)
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+    return c.dump_privatekey(c.FILETYPE_ASN1, key), c.dump_certificate(c.FILETYPE_ASN1, cert)
+
+
+class ValidatorTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.key1, cls.cert1 = make_identity('one')
+        cls.key2, cls.cert2 = make_identity('two')
+
+    def test_validate(self):
+        validator = Validator()
+        self.assertTrue(validator.validate(self.key1, self.cert1))
+        self.assertFalse(validator.validate(self.key1, self.cert2))
+
+    def test_key_and_certificate_share_a_fingerprint(self):
+        validator = Validator()
+        self.assertEqual(validator.key_fingerprint(self.key1), validator.cert_fingerprint(self.cert1))
+        self.assertNotEqual(validator.key_fingerprint(self.key1), validator.cert_fingerprint(self.cert2))
+
+    def test_unparsable_blobs_have_no_fingerprint(self):
+        validator = Validator()
+        self.assertIsNone(validator.key_fingerprint('not a key'))
+        self.assertIsNone(validator.cert_fingerprint('not a certificate'))
+
+    def test_match_pairs_in_certificate_order(self):
+        validator = Validator()
+        certs = [('c2', self.cert2), ('c1', self.cert1), ('bad', 'garbage')]
+        keys = [('k1', self.key1), ('bad', 'garbage'), ('k2', self.key2)]
+        self.assertEqual(validator.match(certs, keys), [('c2', 'k2'), ('c1', 'k1')])
+
+    def test_blobs_are_fingerprinted_once(self):
+        validator = Validator()
+        validator.match([('c1', self.cert1)], [('k1', self.key1)])
+        validator.cert_fingerprints[self.cert1] = 'memoized'
+        self.assertEqual(validator.cert_fingerprint(self.cert1), 'memoized')
+
+
+class IdentityMatcherTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.key1, cls.cert1 = make_identity('one')
+        cls.key2, cls.cert2 = make_identity('two')
+
+    def test_everything_added_is_fingerprinted(self):
+        matcher = IdentityMatcher(verify=True)
+        matcher.add(('keys', 'k1', self.key1, ''))
+        matcher.add(('keys', 'k2', self.key2, ''))
+        self.assertIsNone(matcher.validator)
+        matcher.add(('certs', 'c1', self.cert1, ''))
+        self.assertEqual(sorted(matcher.validator.key_fingerprints), sorted([self.key1, self.key2]))
+        self.assertEqual(matcher.validator.cert_fingerprints.keys(), [self.cert1])
+        matcher.add(('certs', 'c2', self.cert2, ''))
+        matcher.finish()
+        self.assertEqual(sorted(matcher.pairs), [('c1', 'k1'), ('c2', 'k2')])
+
+
+if __name__ == '__main__':
+    unittest.main()
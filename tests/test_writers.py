@@ -0,0 +1,163 @@
+import csv
+import datetime
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+from chainbreaker import (GenericPasswordRecord, KeyRecord, IdentityRecord, TABLE_NAMES,
+                          CSSM_DL_DB_RECORD_GENERIC_PASSWORD, CSSM_DL_DB_RECORD_PRIVATE_KEY, make_writer,
+                          make_exporter)
+from writers import IDENTITY_TABLE, TextWriter, JsonLinesWriter, CsvWriter
+
+GENERIC = CSSM_DL_DB_RECORD_GENERIC_PASSWORD
+PRIVATE_KEY = CSSM_DL_DB_RECORD_PRIVATE_KEY
+TABLE_LABELS = dict((table, name) for name, table in TABLE_NAMES.items())
+
+
+def generic_record(**values):
+    fields = dict(SSGP='\x01\x02', CreationDate=datetime.datetime(2020, 1, 2, 3, 4, 5),
+                  ModDate=datetime.datetime(2020, 1, 2, 3, 4, 5), Description='', Creator='aapl', Type='',
+                  PrintName='wifi\x00\x00', Alias='', Account='me\x00\x00', Service='AirPort', RecordNumber=3,
+                  Password='secret')
+    fields.update(values)
+    return GenericPasswordRecord(**fields)
+
+
+def key_record():
+    return KeyRecord(PrintName='key', Label='\xab' * 20, KeyClass=17, Private=1, KeyType=42, KeySizeInBits=2048,
+                     EffectiveKeySize=2048, Extractable=1, KeyCreator='', IV='\0' * 8, Key='blob', RecordNumber=1,
+                     KeyName='name', PrivateKey='\x30\x82')
+
+
+class JsonLinesWriterTest(unittest.TestCase):
+    def rows(self, records, **kwargs):
+        stream = StringIO()
+        writer = JsonLinesWriter(stream, TABLE_LABELS, **kwargs)
+        for table, record in records:
+            writer.write_record(table, record)
+        writer.close()
+        return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+    def test_values_are_json_friendly(self):
+        row, = self.rows([(GENERIC, generic_record())])
+        self.assertEqual(row['table'], 'generic')
+        self.assertEqual(row['Password'], '736563726574')
+        self.assertEqual(row['SSGP'], '0102')
+        self.assertEqual(row['PrintName'], 'wifi')
+        self.assertEqual(row['Account'], 'me')
+        self.assertEqual(row['CreationDate'], '2020-01-02T03:04:05')
+        self.assertEqual(row['RecordNumber'], 3)
+
+    def test_secret_encodings(self):
+        row, = self.rows([(PRIVATE_KEY, key_record())], secret_encoding='base64')
+        self.assertEqual(row['PrivateKey'], 'MII=')
+        self.assertEqual(row['Label'], 'q6urq6urq6urq6urq6urq6urq6s=')
+
+        row, = self.rows([(PRIVATE_KEY, key_record())], secret_encoding='omit')
+        self.assertNotIn('PrivateKey', row)
+        self.assertEqual(row['Label'], 'ab' * 20)
+
+    def test_context_is_added_to_every_row(self):
+        stream = StringIO()
+        writer = JsonLinesWriter(stream, TABLE_LABELS)
+        writer.context = {'keychain': '/evidence/login.keychain'}
+        writer.write_record(GENERIC, generic_record())
+        writer.close()
+        self.assertEqual(json.loads(stream.getvalue())['keychain'], '/evidence/login.keychain')
+
+    def test_output_is_buffered_until_flushed(self):
+        stream = StringIO()
+        writer = JsonLinesWriter(stream, TABLE_LABELS, buffer_size=1024 * 1024)
+        writer.write_record(GENERIC, generic_record())
+        self.assertEqual(stream.getvalue(), '')
+        writer.close()
+        self.assertEqual(writer.written, len(stream.getvalue()))
+
+
+class CsvWriterTest(unittest.TestCase):
+    def test_one_row_per_record_over_fixed_columns(self):
+        stream = StringIO()
+        writer = make_writer('csv', stream)
+        writer.write_record(GENERIC, generic_record())
+        writer.write_record(PRIVATE_KEY, key_record())
+        writer.close()
+
+        rows = list(csv.DictReader(StringIO(stream.getvalue())))
+        self.assertEqual([row['table'] for row in rows], ['generic', 'privatekey'])
+        self.assertEqual(rows[0]['Service'], 'AirPort')
+        self.assertEqual(rows[0]['KeySizeInBits'], '')
+        self.assertEqual(rows[1]['KeySizeInBits'], '2048')
+
+    def test_omitted_secrets_have_no_column(self):
+        writer = CsvWriter(StringIO(), TABLE_LABELS, 'omit', columns=['Service', 'Password', 'PrivateKey'])
+        self.assertEqual(writer.columns, ['table', 'Service'])
+
+
+class TextWriterTest(unittest.TestCase):
+    def test_report_lines(self):
+        stream = StringIO()
+        writer = TextWriter(stream)
+        writer.status('[+] Symmetric Key Table:')
+        writer.write_record(GENERIC, generic_record())
+        writer.close()
+
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(lines[:2], ['[+] Symmetric Key Table:', '[+] Generic Password Record'])
+        self.assertIn(' [-] Service : AirPort', lines)
+        self.assertTrue(lines[lines.index(' [-] Password') + 1].startswith('00000000: 73 65 63 72 65 74'))
+
+    def test_identity(self):
+        stream = StringIO()
+        writer = make_writer('text', stream)
+        writer.write_record(IDENTITY_TABLE, IdentityRecord('cert', 'key', '\xab' * 20))
+        writer.close()
+        self.assertEqual(stream.getvalue().splitlines()[:4], ['[+] Identity', ' [-] Certificate : cert',
+                                                              ' [-] Private Key : key', ' [-] Public Key Hash'])
+
+
+class SqliteExporterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='chainbreaker-test-')
+        self.path = os.path.join(self.directory, 'export.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_every_export_is_a_run(self):
+        for records in (1, 2):
+            exporter = make_exporter(self.path)
+            exporter.begin(keychain='login.keychain', started='now')
+            for i in xrange(records):
+                exporter.write_record(GENERIC, generic_record(RecordNumber=i))
+            exporter.write_record(PRIVATE_KEY, key_record())
+            exporter.close()
+
+        db = sqlite3.connect(self.path)
+        self.assertEqual(db.execute('SELECT id, keychain, records FROM runs ORDER BY id').fetchall(),
+                         [(1, 'login.keychain', 2), (2, 'login.keychain', 3)])
+        self.assertEqual(db.execute('SELECT run_id, COUNT(*) FROM generic GROUP BY run_id').fetchall(),
+                         [(1, 1), (2, 2)])
+        service, password, account = db.execute('SELECT Service, Password, Account FROM generic').fetchone()
+        self.assertEqual((service, str(password), account), ('AirPort', 'secret', 'me'))
+        self.assertEqual(set(name for name, in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")),
+                         set(['runs'] + TABLE_NAMES.keys()))
+
+    def test_runs_of_one_export(self):
+        exporter = make_exporter(self.path)
+        for keychain in ('a.keychain', 'b.keychain'):
+            exporter.begin(keychain=keychain)
+            exporter.write_record(GENERIC, generic_record())
+            exporter.end()
+        exporter.close()
+
+        db = sqlite3.connect(self.path)
+        self.assertEqual(db.execute('SELECT keychain, records FROM runs ORDER BY id').fetchall(),
+                         [('a.keychain', 1), ('b.keychain', 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
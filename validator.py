@@ -1,3 +1,5 @@
+import hashlib
+
 import OpenSSL.crypto
 from Crypto.Util import asn1
 
@@ -6,7 +8,9 @@ c = OpenSSL.crypto
 
 class Validator:
     def __init__(self):
-        pass
+        # fingerprints by DER data, so blobs fingerprinted ahead of the matching are not parsed twice
+        self.cert_fingerprints = {}
+        self.key_fingerprints = {}
 
     def _get_key(self, key_path):
         st_key = open(key_path, 'rt').read()
@@ -19,9 +23,51 @@ class Validator:
         return cert
 
     def validate_by_filenames(self, key_path, cert_path):
-        key = self._get_key(key_path)
-        cert = self._get_cert(cert_path)
+        return self.validate_keypair(self._get_key(key_path), self._get_cert(cert_path))
+
+    ## DER encoded private key and certificate, as exported
+    def validate(self, key, cert):
+        return self.validate_keypair(c.load_privatekey(c.FILETYPE_ASN1, key),
+                                     c.load_certificate(c.FILETYPE_ASN1, cert))
+
+    ## SHA-1 of the DER SubjectPublicKeyInfo of a DER certificate, None if it does not parse
+    def cert_fingerprint(self, cert):
+        if cert not in self.cert_fingerprints:
+            try:
+                pub = c.load_certificate(c.FILETYPE_ASN1, cert).get_pubkey()
+                self.cert_fingerprints[cert] = hashlib.sha1(c.dump_publickey(c.FILETYPE_ASN1, pub)).digest()
+            except c.Error:
+                self.cert_fingerprints[cert] = None
+        return self.cert_fingerprints[cert]
+
+    ## the same for a DER private key (RSA, EC or DSA), so a key and its certificate share a fingerprint
+    def key_fingerprint(self, key):
+        if key not in self.key_fingerprints:
+            try:
+                pkey = c.load_privatekey(c.FILETYPE_ASN1, key)
+                self.key_fingerprints[key] = hashlib.sha1(c.dump_publickey(c.FILETYPE_ASN1, pkey)).digest()
+            except c.Error:
+                self.key_fingerprints[key] = None
+        return self.key_fingerprints[key]
+
+    def match(self, certs, keys):
+        """Pair certificates with their private keys, fingerprinting every blob once.
+
+        certs and keys are lists of (name, DER data). Returns (cert name, key name) pairs in certificate order.
+        """
+        by_fingerprint = {}
+        for name, key in keys:
+            fingerprint = self.key_fingerprint(key)
+            if fingerprint is not None:
+                by_fingerprint.setdefault(fingerprint, []).append(name)
+
+        pairs = []
+        for name, cert in certs:
+            for key_name in by_fingerprint.get(self.cert_fingerprint(cert), []):
+                pairs.append((name, key_name))
+        return pairs
 
+    def validate_keypair(self, key, cert):
         pub = cert.get_pubkey()
 
         # Only works for RSA (I think)
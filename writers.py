@@ -0,0 +1,392 @@
+# Output writers for decoded keychain records.
+#
+# Every writer takes records one at a time as they stream out of KeyChain.iter_decrypted() and collects the
+# serialized output in a buffer that is written out in large chunks. TextWriter keeps the classic report
+# format (with hexdumps), JsonLinesWriter and CsvWriter emit one machine readable row per record and send
+# status lines to stderr so stdout stays parseable.
+
+import csv
+import datetime
+import json
+import sys
+from base64 import b64encode
+from binascii import hexlify
+from cStringIO import StringIO
+
+from Schema import *
+
+# record fields holding decrypted secrets
+SECRET_FIELDS = ('Password', 'PrivateKey')
+
+# record fields holding binary data rather than text
+BINARY_FIELDS = ('SSGP', 'Subject', 'Issuer', 'SerialNumber', 'SubjectKeyIdentifier', 'PublicKeyHash', 'Certificate',
+                 'Label', 'IV', 'Key', 'KeyName')
+
+# pseudo table of the --identities rows, a certificate with the key pair it belongs to
+IDENTITY_TABLE = 'identity'
+
+SECRET_ENCODINGS = {
+    'hex': hexlify,
+    'base64': b64encode,
+    'omit': None,
+}
+
+
+class RecordWriter:
+    def __init__(self, stream=None, buffer_size=1024 * 1024):
+        self.stream = stream if stream is not None else sys.stdout
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+        self.written = 0
+        self.context = {}  # extra values of structured rows, e.g. the keychain of a batch
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.stream.write(''.join(self.buffer))
+            self.written += self.buffered
+            self.buffer = []
+            self.buffered = 0
+        self.stream.flush()
+
+    ## progress and summary lines
+    def status(self, line):
+        self.flush()
+        sys.stderr.write(line + '\n')
+
+    def write_record(self, table, record):
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+
+
+class TextWriter(RecordWriter):
+    """The classic chainbreaker report, status lines are part of it"""
+
+    def status(self, line):
+        self.write(line + '\n')
+
+    ## hexdump of a value, nothing for an empty one
+    def dump(self, lines, data):
+        if len(data):
+            from hexdump import hexdump
+            lines.append(hexdump(data, result='return'))
+
+    def write_record(self, table, record):
+        lines = []
+        if table == CSSM_DL_DB_RECORD_GENERIC_PASSWORD:
+            lines.append('[+] Generic Password Record')
+            lines.append(' [-] Create DateTime: %s' % record.CreationDate)  # 16byte string
+            lines.append(' [-] Last Modified DateTime: %s' % record.ModDate)  # 16byte string
+            lines.append(' [-] Description : %s' % record.Description)
+            lines.append(' [-] Creator : %s' % record.Creator)
+            lines.append(' [-] Type : %s' % record.Type)
+            lines.append(' [-] PrintName : %s' % record.PrintName)
+            lines.append(' [-] Alias : %s' % record.Alias)
+            lines.append(' [-] Account : %s' % record.Account)
+            lines.append(' [-] Service : %s' % record.Service)
+            lines.append(' [-] Password')
+            self.dump(lines, record.Password)
+            lines.append('')
+
+        elif table == CSSM_DL_DB_RECORD_INTERNET_PASSWORD:
+            lines.append('[+] Internet Record')
+            lines.append(' [-] Create DateTime: %s' % record.CreationDate)  # 16byte string
+            lines.append(' [-] Last Modified DateTime: %s' % record.ModDate)  # 16byte string
+            lines.append(' [-] Description : %s' % record.Description)
+            lines.append(' [-] Comment : %s' % record.Comment)
+            lines.append(' [-] Creator : %s' % record.Creator)
+            lines.append(' [-] Type : %s' % record.Type)
+            lines.append(' [-] PrintName : %s' % record.PrintName)
+            lines.append(' [-] Alias : %s' % record.Alias)
+            lines.append(' [-] Protected : %s' % record.Protected)
+            lines.append(' [-] Account : %s' % record.Account)
+            lines.append(' [-] SecurityDomain : %s' % record.SecurityDomain)
+            lines.append(' [-] Server : %s' % record.Server)
+            try:
+                lines.append(' [-] Protocol Type : %s' % PROTOCOL_TYPE[record.Protocol])
+            except KeyError:
+                lines.append(' [-] Protocol Type : %s' % record.Protocol)
+            try:
+                lines.append(' [-] Auth Type : %s' % AUTH_TYPE[record.AuthType])
+            except KeyError:
+                lines.append(' [-] Auth Type : %s' % record.AuthType)
+            lines.append(' [-] Port : %d' % record.Port)
+            lines.append(' [-] Path : %s' % record.Path)
+            lines.append(' [-] Password')
+            self.dump(lines, record.Password)
+            lines.append('')
+
+        elif table == CSSM_DL_DB_RECORD_APPLESHARE_PASSWORD:
+            lines.append('[+] AppleShare Record (no more used OS X)')
+            # lines.append('')
+            # lines.append(' [-] Create DateTime: %s' % record.CreationDate)  # 16byte string
+            # lines.append(' [-] Last Modified DateTime: %s' % record.ModDate)  # 16byte string
+            # lines.append(' [-] Description : %s' % record.Description)
+            # lines.append(' [-] Comment : %s' % record.Comment)
+            # lines.append(' [-] Creator : %s' % record.Creator)
+            # lines.append(' [-] Type : %s' % record.Type)
+            # lines.append(' [-] PrintName : %s' % record.PrintName)
+            # lines.append(' [-] Alias : %s' % record.Alias)
+            # lines.append(' [-] Protected : %s' % record.Protected)
+            # lines.append(' [-] Account : %s' % record.Account)
+            # lines.append(' [-] Volume : %s' % record.Volume)
+            # lines.append(' [-] Server : %s' % record.Server)
+            # try:
+                # lines.append(' [-] Protocol Type : %s' % PROTOCOL_TYPE[record.Protocol])
+            # except KeyError:
+            #     lines.append(' [-] Protocol Type : %s' % record.Protocol)
+            # lines.append(' [-] Address : %d' % record.Address)
+            # lines.append(' [-] Signature : %s' % record.Signature)
+            # lines.append(' [-] Password')
+            # self.dump(lines, record.Password)
+            # lines.append('')
+
+        elif table == CSSM_DL_DB_RECORD_X509_CERTIFICATE:
+            lines.append('[+] Certificate')
+            # lines.append(' [-] Cert Type: %s' % CERT_TYPE[record.CertType])
+            # lines.append(' [-] Cert Encoding: %s' % CERT_ENCODING[record.CertEncoding])
+            # lines.append(' [-] PrintName : %s' % record.PrintName)
+            # lines.append(' [-] Alias : %s' % record.Alias)
+            # lines.append(' [-] Subject')
+            # self.dump(lines, record.Subject)
+            # lines.append(' [-] Issuer :')
+            # self.dump(lines, record.Issuer)
+            # lines.append(' [-] SerialNumber')
+            # self.dump(lines, record.SerialNumber)
+            # lines.append(' [-] SubjectKeyIdentifier')
+            # self.dump(lines, record.SubjectKeyIdentifier)
+            # lines.append(' [-] Public Key Hash')
+            # self.dump(lines, record.PublicKeyHash)
+            # lines.append(' [-] Certificate')
+            # self.dump(lines, record.Certificate)
+            # lines.append('')
+
+        elif table == CSSM_DL_DB_RECORD_PUBLIC_KEY:
+            lines.append('[+] Public Key Record')
+            # lines.append(' [-] PrintName: %s' % record.PrintName)
+            # lines.append(' [-] Label')
+            # self.dump(lines, record.Label)
+            # lines.append(' [-] Key Class : %s' % KEY_TYPE[record.KeyClass])
+            # lines.append(' [-] Private : %d' % record.Private)
+            # lines.append(' [-] Key Type : %s' % CSSM_ALGORITHMS[record.KeyType])
+            # lines.append(' [-] Key Size : %d bits' % record.KeySizeInBits)
+            # lines.append(' [-] Effective Key Size : %d bits' % record.EffectiveKeySize)
+            # lines.append(' [-] Extracted : %d' % record.Extractable)
+            # lines.append(' [-] CSSM Type : %s' % STD_APPLE_ADDIN_MODULE[record.KeyCreator])
+            # lines.append(' [-] Public Key')
+            # self.dump(lines, record.Key)
+            # lines.append('')
+
+        elif table == CSSM_DL_DB_RECORD_PRIVATE_KEY:
+            lines.append('[+] Private Key Record')
+            # lines.append(' [-] PrintName: %s' % record.PrintName)
+            # lines.append(' [-] Label')
+            # self.dump(lines, record.Label)
+            # lines.append(' [-] Key Class : %s' % KEY_TYPE[record.KeyClass])
+            # lines.append(' [-] Private : %d' % record.Private)
+            # lines.append(' [-] Key Type : %s' % CSSM_ALGORITHMS[record.KeyType])
+            # lines.append(' [-] Key Size : %d bits' % record.KeySizeInBits)
+            # lines.append(' [-] Effective Key Size : %d bits' % record.EffectiveKeySize)
+            # lines.append(' [-] Extracted : %d' % record.Extractable)
+            # lines.append(' [-] CSSM Type : %s' % STD_APPLE_ADDIN_MODULE[record.KeyCreator])
+            # lines.append(' [-] Key Name')
+            # self.dump(lines, record.KeyName)
+            # lines.append(' [-] Decrypted Private Key')
+            # self.dump(lines, record.PrivateKey)
+            # lines.append('')
+
+        elif table == IDENTITY_TABLE:
+            lines.append('[+] Identity')
+            lines.append(' [-] Certificate : %s' % record.CertificateName)
+            lines.append(' [-] Private Key : %s' % record.PrivateKeyName)
+            lines.append(' [-] Public Key Hash')
+            self.dump(lines, record.PublicKeyHash)
+            lines.append('')
+
+        if lines:
+            self.write('\n'.join(lines) + '\n')
+
+
+class StructuredWriter(RecordWriter):
+    """Base of the machine readable writers: every record becomes a flat dict of JSON compatible values"""
+
+    def __init__(self, stream=None, table_names=None, secret_encoding='hex', buffer_size=1024 * 1024):
+        RecordWriter.__init__(self, stream, buffer_size)
+        self.table_names = table_names if table_names is not None else {}
+        self.encode_secret = SECRET_ENCODINGS[secret_encoding]
+        self.encode_binary = self.encode_secret if self.encode_secret is not None else hexlify
+
+    def serialize(self, table, record):
+        row = {'table': self.table_names.get(table, table)}
+        row.update(self.context)
+        for field, value in zip(record._fields, record):
+            if field in SECRET_FIELDS:
+                if self.encode_secret is None:
+                    continue
+                value = self.encode_secret(value)
+            elif field in BINARY_FIELDS:
+                value = self.encode_binary(value)
+            elif isinstance(value, datetime.datetime):
+                value = value.isoformat()
+            elif isinstance(value, str):
+                # attributes are NUL padded to a 4 byte boundary
+                value = value.rstrip('\x00').decode('utf-8', 'replace')
+            row[field] = value
+        return row
+
+
+class JsonLinesWriter(StructuredWriter):
+    """One JSON object per line (NDJSON)"""
+
+    def write_record(self, table, record):
+        self.write(json.dumps(self.serialize(table, record), sort_keys=True) + '\n')
+
+
+class CsvWriter(StructuredWriter):
+    """One CSV row per record over a fixed set of columns, fields a record type lacks are left empty"""
+
+    def __init__(self, stream=None, table_names=None, secret_encoding='hex', buffer_size=1024 * 1024, columns=()):
+        StructuredWriter.__init__(self, stream, table_names, secret_encoding, buffer_size)
+        self.columns = ['table'] + [column for column in columns
+                                    if column not in SECRET_FIELDS or self.encode_secret is not None]
+        self.rowbuf = StringIO()
+        self.csv = csv.writer(self.rowbuf)
+        self.header_written = False
+
+    def write_record(self, table, record):
+        if not self.header_written:
+            self.csv.writerow(self.columns)
+            self.header_written = True
+
+        row = self.serialize(table, record)
+        values = []
+        for column in self.columns:
+            value = row.get(column, '')
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            values.append(value)
+        self.csv.writerow(values)
+
+        self.write(self.rowbuf.getvalue())
+        self.rowbuf.seek(0)
+        self.rowbuf.truncate()
+
+
+WRITERS = {
+    'text': TextWriter,
+    'jsonl': JsonLinesWriter,
+    'csv': CsvWriter,
+}
+
+
+class SqliteExporter:
+    """Bulk loads decoded records into a SQLite database, one table per record type plus a runs table.
+
+    Rows are inserted with executemany() in batches inside a single transaction and the indexes are created
+    after the load. Exporting into an existing database adds a new run.
+    """
+
+    BATCH_SIZE = 5000
+
+    # columns indexed after the load, where the record type has them
+    INDEXED_COLUMNS = ('RecordNumber', 'Service', 'Account', 'Server', 'PrintName', 'Label', 'PublicKeyHash')
+
+    def __init__(self, path, table_names, record_types):
+        self.table_names = table_names
+        self.record_types = record_types
+        self.pending = {}  # table -> rows not inserted yet
+        self.count = 0
+        self.run_id = None
+        self.run_start = 0  # count at the beginning of the current run
+
+        import sqlite3
+        self.binary = sqlite3.Binary
+
+        # transactions are managed here, the whole export is a single one
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute('PRAGMA synchronous = OFF')
+        self.db.execute('PRAGMA journal_mode = MEMORY')
+        self.db.execute('BEGIN')
+        self.createTables()
+
+    def createTables(self):
+        self.db.execute('CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, keychain TEXT, '
+                        'keychain_size INTEGER, keychain_sha256 TEXT, unlocked_with TEXT, tables TEXT, '
+                        'filters TEXT, started TEXT, finished TEXT, records INTEGER)')
+        for table, record_type in self.record_types.items():
+            columns = ['run_id INTEGER REFERENCES runs(id)']
+            for field in record_type._fields:
+                columns.append('%s %s' % (field, self.columnType(field)))
+            self.db.execute('CREATE TABLE IF NOT EXISTS %s (%s)' % (self.table_names[table], ', '.join(columns)))
+
+    def columnType(self, field):
+        if field in SECRET_FIELDS or field in BINARY_FIELDS:
+            return 'BLOB'
+        if field in ('RecordNumber', 'Port', 'CertType', 'CertEncoding', 'KeyClass', 'Private', 'KeyType',
+                     'KeySizeInBits', 'EffectiveKeySize', 'Extractable'):
+            return 'INTEGER'
+        return 'TEXT'
+
+    ## start a run, provenance maps runs columns to values
+    def begin(self, **provenance):
+        provenance.setdefault('started', datetime.datetime.utcnow().isoformat())
+        columns = sorted(provenance)
+        cursor = self.db.execute('INSERT INTO runs (%s) VALUES (%s)' % (', '.join(columns),
+                                                                        ', '.join('?' * len(columns))),
+                                 [provenance[column] for column in columns])
+        self.run_id = cursor.lastrowid
+        self.run_start = self.count
+
+    ## finish the current run, another one can begin() afterwards
+    def end(self):
+        if self.run_id is not None:
+            self.db.execute('UPDATE runs SET finished = ?, records = ? WHERE id = ?',
+                            (datetime.datetime.utcnow().isoformat(), self.count - self.run_start, self.run_id))
+            self.run_id = None
+
+    def convert(self, field, value):
+        if field in SECRET_FIELDS or field in BINARY_FIELDS:
+            return self.binary(value)
+        if isinstance(value, datetime.datetime):
+            return value.isoformat()
+        if isinstance(value, str):
+            # attributes are NUL padded to a 4 byte boundary
+            return value.rstrip('\x00').decode('utf-8', 'replace')
+        return value
+
+    def write_record(self, table, record):
+        row = [self.run_id] + [self.convert(field, value) for field, value in zip(record._fields, record)]
+        rows = self.pending.setdefault(table, [])
+        rows.append(row)
+        self.count += 1
+        if len(rows) >= self.BATCH_SIZE:
+            self.flush(table)
+
+    def flush(self, table):
+        rows = self.pending.pop(table, [])
+        if rows:
+            self.db.executemany('INSERT INTO %s VALUES (%s)' % (self.table_names[table], ', '.join('?' * len(rows[0]))),
+                                rows)
+
+    def close(self):
+        for table in self.pending.keys():
+            self.flush(table)
+
+        for table, record_type in self.record_types.items():
+            name = self.table_names[table]
+            self.db.execute('CREATE INDEX IF NOT EXISTS %s_run ON %s (run_id)' % (name, name))
+            for field in self.INDEXED_COLUMNS:
+                if field in record_type._fields:
+                    self.db.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)' % (name, field, name, field))
+
+        self.end()
+        self.db.execute('COMMIT')
+        self.db.close()